@@ -9,44 +9,297 @@ import sublime
 import functools
 import locale
 import threading
+import queue
 import tempfile
-from .sourcemap import load
+import shutil
+import multiprocessing
+import traceback
+import json
+import time
+import re
+import hashlib
+import difflib
+import itertools
+from collections import OrderedDict, deque
+from bisect import bisect_right
+from .sourcemap import CompactSourceMapDecoder, SourceMapCache
+
+
+class SettingsSnapshot():
+    """
+    Resolved settings for one view: its "TypeScript" project settings over
+    the plugin settings. Values are looked up once and remembered, and what
+    the compiler needs from them is worked out up front, so compiling does
+    no settings lookups. current_settings drops snapshots when either
+    settings object changes.
 
+    :param plugin_settings:
+        The loaded TypeScript.sublime-settings
+
+    :param project_settings:
+        The view's "TypeScript" settings dict
+    """
+
+    missing = object()
+
+    def __init__(self, plugin_settings, project_settings):
+        self.plugin_settings = plugin_settings
+        self.project_settings = project_settings
+        self.values = {}
+        # filled in by output_dir
+        self.output_dirs = {}
+        self.compile_path_trie = None
+
+        # tsc flags for the compile options
+        self.compiler_args = []
+        module = self.get("module", "")
+        if module:
+            self.compiler_args += ["--module", module]
+        target = self.get("target", "ES3")
+        if target:
+            self.compiler_args += ["--target", target]
+        noImplicitAny = self.get("noImplicitAny", False)
+        if noImplicitAny:
+            self.compiler_args += ["--noImplicitAny"]
+
+        # the same as compiler server options, without sourceMap
+        self.server_options = {"target": target, "noImplicitAny": bool(noImplicitAny)}
+        if module:
+            self.server_options["module"] = module
+
+        # Environment for compiler processes: PATH built from binDir and envPATH.
+        # Windows inherits the plugin host environment.
+        if sys.platform == "win32":
+            self.compiler_env = None
+        else:
+            self.compiler_env = {"PATH": self.get('binDir', '/usr/bin')}
+            # adding custom PATHs from settings
+            customEnv = self.get('envPATH', "")
+            if customEnv:
+                self.compiler_env["PATH"] = self.compiler_env["PATH"]+":"+customEnv
+
+    def get(self, name, default=None):
+        try:
+            value = self.values[name]
+        except KeyError:
+            if name in self.project_settings:
+                value = self.project_settings[name]
+            elif self.plugin_settings.has(name):
+                value = self.plugin_settings.get(name)
+            else:
+                value = self.missing
+            self.values[name] = value
+        return default if value is self.missing else value
+
+    def compiler_options(self, sourcemap=False):
+        """
+        Compiler options for the server, the same the compiler_args flags
+        set on tsc.
+        """
+        options = dict(self.server_options)
+        options["sourceMap"] = bool(sourcemap)
+        return options
+
+
+# view id (None without a view) -> SettingsSnapshot
+settings_snapshots = {}
+# called with no arguments whenever settings change
+settings_listeners = []
+plugin_settings_watched = []
+
+
+def invalidate_settings(view_id=None):
+    """
+    Drop the snapshot of one view, or all of them.
+    """
+    if view_id is None:
+        settings_snapshots.clear()
+    else:
+        settings_snapshots.pop(view_id, None)
+    for listener in settings_listeners:
+        listener()
+
+
+def view_settings_changed(view_id, view_settings):
+    """
+    The on_change of a view's settings, which other plugins fire all the
+    time. Only a change of its "TypeScript" value invalidates the view.
+    """
+    snapshot = settings_snapshots.get(view_id)
+    if snapshot is not None and (view_settings.get("TypeScript") or {}) != snapshot.project_settings:
+        invalidate_settings(view_id)
+
+
+def current_settings(view=None):
+    """
+    The SettingsSnapshot of view, the active view by default.
+    """
+    if view is None:
+        window = sublime.active_window()
+        view = window.active_view() if window else None
+    view_id = view.id() if view else None
+    snapshot = settings_snapshots.get(view_id)
+    if snapshot is not None:
+        return snapshot
 
-def settings_get(name, default=None):
     # load up the plugin settings
     plugin_settings = sublime.load_settings('TypeScript.sublime-settings')
+    if not plugin_settings_watched:
+        plugin_settings.add_on_change('better-typescript', invalidate_settings)
+        plugin_settings_watched.append(plugin_settings)
+
     # project plugin settings? sweet! no project plugin settings? ok, well promote plugin_settings up then
-    if sublime.active_window() and sublime.active_window().active_view():
-        project_settings = sublime.active_window().active_view().settings().get("TypeScript")
-    else:
-        project_settings = {}
+    project_settings = None
+    if view:
+        view_settings = view.settings()
+        project_settings = view_settings.get("TypeScript")
+        view_settings.clear_on_change('better-typescript')
+        view_settings.add_on_change('better-typescript', lambda: view_settings_changed(view_id, view_settings))
 
     # what if this isn't a project?
     # the project_settings would return None (?)
     if project_settings is None:
         project_settings = {}
 
-    setting = project_settings.get(name, plugin_settings.get(name, default))
-    return setting
+    with timings.span('settings'):
+        snapshot = SettingsSnapshot(plugin_settings, project_settings)
+    settings_snapshots[view_id] = snapshot
+    return snapshot
+
+
+def settings_get(name, default=None):
+    return current_settings().get(name, default)
+
+
+# (program, PATH) -> whether it is there
+available_programs = {}
+
 
 def program_available(program):
-    
-    def is_exe(fpath):
-        return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
-
-    fpath, fname = os.path.split(program)
-    if fpath:
-        if is_exe(program):
-            return True
-    else:
-        for path in os.environ["PATH"].split(os.pathsep):
-            path = path.strip('"')
-            exe_file = os.path.join(path, program)
-            if is_exe(exe_file):
-                return True
+    """
+    Whether program is an executable path, or found on PATH. Answers are
+    remembered per PATH.
+    """
+    search_path = os.environ["PATH"]
+    key = (program, search_path)
+    if key not in available_programs:
+        if os.path.split(program)[0]:
+            found = os.path.isfile(program) and os.access(program, os.X_OK)
+        else:
+            found = find_program(program, search_path) is not None
+        available_programs[key] = found or None
+    return available_programs[key]
+
+
+class TimingSpan():
+    """
+    Times a with block and adds it to timings.
+    """
+
+    def __init__(self, timings, phase, file=None):
+        self.timings = timings
+        self.phase = phase
+        self.file = file
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.phase, time.perf_counter() - self.start, self.file)
+
+
+class NullSpan():
+    """
+    The span handed out while timings are off, times nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+null_span = NullSpan()
+
+
+class Timings():
+    """
+    Rolling timings of the phases of compiling and watching, overall and
+    per file: the last `window` samples of each. Collected only with the
+    performanceTimings setting on, otherwise span() hands out null_span
+    and instrumented code pays for one attribute check.
+    """
+
+    window = 500
+    # histogram bucket bounds in milliseconds
+    buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = OrderedDict()
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def configure(self):
+        self.enabled = bool(settings_get('performanceTimings', False))
+
+    def span(self, phase, file=None):
+        if not self.enabled:
+            return null_span
+        return TimingSpan(self, phase, file)
+
+    def add(self, phase, seconds, file=None):
+        with self.lock:
+            samples = self.phases.get(phase)
+            if samples is None:
+                samples = self.phases[phase] = deque(maxlen=self.window)
+            samples.append(seconds)
+            if file is not None:
+                samples = self.files.setdefault(file, OrderedDict()).get(phase)
+                if samples is None:
+                    samples = self.files[file][phase] = deque(maxlen=self.window)
+                samples.append(seconds)
+
+    def summary(self, samples):
+        """
+        Count, mean, percentiles and histogram of samples, in milliseconds.
+        """
+        samples = sorted(seconds * 1000 for seconds in samples)
+        pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+        histogram = OrderedDict()
+        i = 0
+        for bound in self.buckets:
+            count = bisect_right(samples, bound) - i
+            histogram['<=%dms' % bound] = count
+            i += count
+        histogram['>%dms' % self.buckets[-1]] = len(samples) - i
+        return OrderedDict([("count", len(samples)), ("mean", sum(samples) / len(samples)),
+                            ("p50", pick(0.5)), ("p90", pick(0.9)), ("p99", pick(0.99)),
+                            ("max", samples[-1]), ("histogram", histogram)])
+
+    def report(self):
+        with self.lock:
+            phases = [(phase, list(samples)) for phase, samples in self.phases.items()]
+            files = [(file, [(phase, list(samples)) for phase, samples in self.files[file].items()])
+                     for file in sorted(self.files)]
+        return OrderedDict([
+            ("enabled", self.enabled),
+            ("phases", OrderedDict((phase, self.summary(samples)) for phase, samples in phases)),
+            ("files", OrderedDict((file, OrderedDict((phase, self.summary(samples)) for phase, samples in file_phases))
+                                  for file, file_phases in files)),
+        ])
+
+    def clear(self):
+        with self.lock:
+            self.phases.clear()
+            self.files.clear()
+
+
+timings = Timings()
+settings_listeners.append(timings.configure)
 
-    return None
 
 def run(cmd, args=[], source="", cwd=None, env=None, callback=None):
     """
@@ -54,96 +307,220 @@ def run(cmd, args=[], source="", cwd=None, env=None, callback=None):
     Will run on thread if callback function is passed.
     """
     if callback:
-        thread = threading.Thread(target=lambda cb: cb(_run(cmd, args=args, source=source, cwd=cwd, env=env)), args=(callback,))
-        thread.start()
-        ThreadProgress(thread, 'Compiling', '')
+        run_async(lambda: _run(cmd, args=args, source=source, cwd=cwd, env=env), callback)
     else:
         res = _run(cmd, args=args, source=source, cwd=cwd, env=env)
         return res
 
 
-def _run(cmd, args=[], source="", cwd=None, env=None):
+# Worker pool priorities, lower runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+
+def run_async(work, callback, priority=PRIORITY_INTERACTIVE):
+    """
+    Call work() on the worker pool and pass its result to callback.
+    """
+    worker_pool.submit(work, callback, priority)
+
+
+def _run(cmd, args=[], source="", cwd=None, env=None, job=None, settings=None, on_diagnostics=None, label=None):
+    """
+    Run cmd and collect what it prints. Output is read line by line while
+    it runs and parsed into the "diagnostics" of the result, passed in
+    batches to on_diagnostics as they come. Timings go under label, the
+    file compiled by default.
+    """
+    timed = timings.enabled
+    if timed:
+        started = time.perf_counter()
     if not type(args) is list:
         args = [args]
 
-    module = settings_get("module", "")
-    if module:
-        args += ["--module", module]
+    settings = settings or current_settings()
+    args = args + settings.compiler_args
+    if timed and label is None:
+        sources = [arg for arg in args if arg.endswith('.ts')]
+        label = sources[0] if len(sources) == 1 else '%d files' % len(sources)
+    if timed:
+        timings.add('arguments', time.perf_counter() - started, label)
 
-    target = settings_get("target", "ES3")
-    if target:
-        args += ["--target", target]
-
-    noImplicitAny = settings_get("noImplicitAny", False)
-    if noImplicitAny:
-        args += ["--noImplicitAny"]
+    if job is not None and on_diagnostics is not None:
+        callback = on_diagnostics
+        on_diagnostics = lambda batch: job.cancelled or callback(batch)
+    stream = DiagnosticStream(cwd, on_diagnostics)
 
     if sys.platform == "win32":
         args = [cmd] + args
         if sys.version_info[0] == 2:
             for i in range(len(args)):
                 args[i] = args[i].encode(locale.getdefaultlocale()[1])
-        proc = Popen(args, env=env, cwd=cwd, stdout=PIPE, stdin=PIPE, stderr=PIPE, shell=True)
+        with timings.span('spawn', label):
+            proc = Popen(args, env=env, cwd=cwd, stdout=PIPE, stdin=PIPE, stderr=PIPE, shell=True)
+        if job is not None:
+            job.attach(proc)
         try:
-            stat = proc.communicate(input=source)
-        except:
-            stat = proc.communicate(input=source.encode("utf8"))
-        okay = proc.returncode == 0
-        return {"okay": okay, "out": stat[0].decode(locale.getdefaultlocale()[1]), "err": stat[1].decode(locale.getdefaultlocale()[1])}
+            proc.stdin.write(source.encode("utf8"))
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        with timings.span('compiler', label):
+            out, err = read_output(proc, locale.getdefaultlocale()[1], stream, label)
     else:
         if env is None:
-            env = {"PATH": settings_get('binDir', '/usr/bin')}
-
-        # adding custom PATHs from settings
-        customEnv = settings_get('envPATH', "")
-        if customEnv:
-            env["PATH"] = env["PATH"]+":"+customEnv
+            env = settings.compiler_env
 
         if source :
             command = [cmd] + args + [source]
         else:
             command = [cmd] + args
         print(command)
-        proc = Popen(command, env=env, cwd=cwd, stdout=PIPE, stderr=PIPE)
-        stat = proc.communicate()
-        okay = proc.returncode == 0
-        return {"okay": okay, "out": stat[0].decode('utf-8'), "err": stat[1].decode('utf-8')}
+        with timings.span('spawn', label):
+            proc = Popen(command, env=env, cwd=cwd, stdout=PIPE, stderr=PIPE)
+        if job is not None:
+            job.attach(proc)
+        with timings.span('compiler', label):
+            out, err = read_output(proc, 'utf-8', stream, label)
+    okay = proc.returncode == 0
+    return {"okay": okay, "out": out, "err": err, "diagnostics": stream.close()}
+
+
+def read_output(proc, encoding, stream, label=None):
+    """
+    Read stdout and stderr of proc line by line until it exits, feeding
+    every line to stream. stderr is drained on a thread of its own so
+    neither pipe fills up. Returns the text of both.
+    """
+    timed = timings.enabled
+    # seconds spent decoding and parsing, for timings
+    spent = [0.0, 0.0]
+
+    def consume(line, lines):
+        if not timed:
+            line = line.decode(encoding, 'replace')
+            lines.append(line)
+            stream.feed(line)
+            return
+        start = time.perf_counter()
+        line = line.decode(encoding, 'replace')
+        decoded = time.perf_counter()
+        lines.append(line)
+        stream.feed(line)
+        spent[0] += decoded - start
+        spent[1] += time.perf_counter() - decoded
+
+    err = []
+
+    def drain():
+        for line in iter(proc.stderr.readline, b''):
+            consume(line, err)
+
+    reader = threading.Thread(target=drain)
+    reader.daemon = True
+    reader.start()
+    out = []
+    for line in iter(proc.stdout.readline, b''):
+        consume(line, out)
+    reader.join()
+    proc.wait()
+    if timed:
+        timings.add('output decode', spent[0], label)
+        timings.add('diagnostic parsing', spent[1], label)
+    return "".join(out), "".join(err)
+
+
+# file(line,col): category TScode: message, the way tsc reports a diagnostic
+DIAGNOSTIC_PATTERN = re.compile(
+    r'^(?P<file>.+?)\((?P<line>\d+),(?P<col>\d+)\): (?P<category>error|warning|message|suggestion) '
+    r'(?P<code>TS\d+): (?P<message>.*)$')
+
+
+class DiagnosticStream():
+    """
+    Parses compiler output into diagnostics one line at a time and hands
+    them to callback in batches: the first one right away, the rest at
+    most every interval seconds and whatever is left on close().
 
+    A diagnostic is a dict of "file" (absolute, relative paths are taken
+    from cwd), "line" and "col" (zero based), "category", "code" and
+    "message".
+    """
 
-class ThreadProgress():
+    def __init__(self, cwd=None, callback=None, interval=0.05):
+        self.cwd = cwd or os.getcwd()
+        self.callback = callback
+        self.interval = interval
+        self.diagnostics = []
+        self.pending = []
+        self.flushed = 0
+        self.lock = threading.Lock()
+
+    def feed(self, line):
+        match = DIAGNOSTIC_PATTERN.match(line.rstrip('\r\n'))
+        if match is None:
+            return
+        diagnostic = {
+            "file": os.path.join(self.cwd, match.group('file')),
+            "line": int(match.group('line')) - 1,
+            "col": int(match.group('col')) - 1,
+            "category": match.group('category'),
+            "code": match.group('code'),
+            "message": match.group('message'),
+        }
+        with self.lock:
+            self.diagnostics.append(diagnostic)
+            if self.callback is None:
+                return
+            self.pending.append(diagnostic)
+            now = time.time()
+            if now - self.flushed < self.interval:
+                return
+            batch, self.pending, self.flushed = self.pending, [], now
+        self.callback(batch)
+
+    def close(self):
+        """
+        Flush what is pending and return all diagnostics seen.
+        """
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if batch:
+            self.callback(batch)
+        return self.diagnostics
+
+
+class PoolProgress():
     """
-    Animates an indicator, [=   ], in the status area while a thread runs
+    Animates an indicator, [=   ], in the status area while the worker pool
+    has work, with the number of jobs running and waiting
 
-    :param thread:
-        The thread to track for activity
+    :param pool:
+        The WorkerPool to track for activity
 
     :param message:
         The message to display next to the activity indicator
-
-    :param success_message:
-        The message to display once the thread is complete
     """
 
-    def __init__(self, thread, message, success_message):
-        self.thread = thread
+    def __init__(self, pool, message):
+        self.pool = pool
         self.message = message
-        self.success_message = success_message
         self.addend = 1
         self.size = 8
         sublime.set_timeout(lambda: self.run(0), 100)
 
     def run(self, i):
-        if not self.thread.is_alive():
-            if hasattr(self.thread, 'result') and not self.thread.result:
-                sublime.status_message('')
-                return
-            sublime.status_message(self.success_message)
+        running, queued = self.pool.counts()
+        if not running and not queued:
+            self.pool.progress = None
+            sublime.status_message('')
             return
 
         before = i % self.size
         after = (self.size - 1) - before
 
-        sublime.status_message('%s [%s=%s]' % (self.message, ' ' * before, ' ' * after))
+        count = '%d running, %d queued' % (running, queued) if queued else '%d running' % running
+        sublime.status_message('%s (%s) [%s=%s]' % (self.message, count, ' ' * before, ' ' * after))
 
         if not after:
             self.addend = -1
@@ -154,18 +531,1010 @@ class ThreadProgress():
         sublime.set_timeout(lambda: self.run(i), 100)
 
 
-def brew(args, source, cwd=None, callback=None):
+class WorkerPool():
+    """
+    Runs submitted work on a bounded number of threads, lower priority
+    values first and in submission order within a priority. The bound is
+    the maxConcurrentCompiles setting, the number of cores when 0, taken
+    again by configure whenever settings change.
+    """
+
+    def __init__(self):
+        self.queue = queue.PriorityQueue()
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.size = multiprocessing.cpu_count()
+        self.workers = 0
+        self.running = 0
+        self.queued = 0
+        self.progress = None
+
+    def configure(self):
+        size = settings_get('maxConcurrentCompiles', 0) or multiprocessing.cpu_count()
+        with self.lock:
+            self.size = size
+
+    def submit(self, work, callback, priority=PRIORITY_INTERACTIVE):
+        with self.lock:
+            self.seq += 1
+            self.queued += 1
+            self.queue.put((priority, self.seq, work, callback))
+            spawn = self.workers < self.size
+            if spawn:
+                self.workers += 1
+            if self.progress is None:
+                self.progress = PoolProgress(self, 'Compiling')
+        if spawn:
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            with self.lock:
+                # the setting went down
+                if self.workers > self.size:
+                    self.workers -= 1
+                    return
+            priority, seq, work, callback = self.queue.get()
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                callback(work())
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+    def counts(self):
+        with self.lock:
+            return self.running, self.queued
+
+
+worker_pool = WorkerPool()
+settings_listeners.append(worker_pool.configure)
+
+
+class CompilerServerError(Exception):
+    pass
+
+
+class CompilerServer():
+    """
+    A long-lived tsserver process kept for one project root.
+
+    Requests go to stdin as one line of JSON each, responses come back on
+    stdout framed by a Content-Length header. Node startup and the program's
+    type information are paid for once instead of on every compile.
+
+    :param root:
+        The project root the server is kept for
+
+    :param command:
+        The argument vector that starts tsserver
+
+    :param env:
+        The environment of the server process
+    """
+
+    # Seconds without traffic after which the server is pinged before use
+    idle_check = 60
+
+    def __init__(self, root, command, env=None):
+        self.root = root
+        self.command = command
+        self.env = env
+        self.proc = None
+        self.seq = 0
+        self.pending = {}
+        # the external project every compiled file is put in, see set_project
+        self.project_name = os.path.join(root, 'better-typescript')
+        self.project_files = set()
+        self.options = None
+        self.failed = False
+        self.last_response = 0
+        self.timeout = 30
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        # tsserver handles one request at a time and the project options
+        # are shared, so compiles on one server are serialized
+        self.compile_lock = threading.Lock()
+
+    def start(self):
+        self.devnull = open(os.devnull, 'wb')
+        self.proc = Popen(self.command + ['--disableAutomaticTypingAcquisition'],
+                          env=self.env, cwd=self.root, stdin=PIPE, stdout=PIPE, stderr=self.devnull)
+        self.last_response = time.time()
+        reader = threading.Thread(target=self._read_loop)
+        reader.daemon = True
+        reader.start()
+        print("Started compiler server for " + self.root)
+
+    def _read_loop(self):
+        stdout = self.proc.stdout
+        while True:
+            length = None
+            while True:
+                header = stdout.readline()
+                if not header:
+                    self._abort()
+                    return
+                header = header.strip()
+                if not header:
+                    if length is None:
+                        continue
+                    break
+                if header.lower().startswith(b'content-length:'):
+                    length = int(header.split(b':', 1)[1])
+            body = stdout.read(length)
+            try:
+                message = json.loads(body.decode('utf-8'))
+            except ValueError:
+                continue
+            self.last_response = time.time()
+            # events (project loading, telemetry, ...) are not waited for
+            if message.get('type') != 'response':
+                continue
+            with self.lock:
+                slot = self.pending.pop(message.get('request_seq'), None)
+            if slot:
+                slot['response'] = message
+                slot['event'].set()
+
+    def _abort(self):
+        self.failed = True
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for slot in pending.values():
+            slot['event'].set()
+
+    def _send(self, message):
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        try:
+            with self.write_lock:
+                self.proc.stdin.write(data)
+                self.proc.stdin.flush()
+        except (IOError, OSError, ValueError):
+            self.failed = True
+            raise CompilerServerError('compiler server is not running')
+
+    def notify(self, command, arguments=None):
+        """
+        Send a request tsserver does not answer, like "open" or "close".
+        """
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+        self._send({'seq': seq, 'type': 'request', 'command': command, 'arguments': arguments or {}})
+
+    def request(self, command, arguments=None, timeout=None):
+        """
+        Send a request and wait for its response body.
+        """
+        slot = {'event': threading.Event(), 'response': None}
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+            self.pending[seq] = slot
+        self._send({'seq': seq, 'type': 'request', 'command': command, 'arguments': arguments or {}})
+        if not slot['event'].wait(timeout or self.timeout):
+            with self.lock:
+                self.pending.pop(seq, None)
+            # a server that stops answering is restarted on next use
+            self.failed = True
+            raise CompilerServerError(command + ' timed out')
+        response = slot['response']
+        if response is None:
+            raise CompilerServerError('compiler server exited')
+        if not response.get('success'):
+            raise CompilerServerError(response.get('message') or command + ' failed')
+        return response.get('body')
+
+    def healthy(self):
+        """
+        Whether the process is up and answering. A server that has been quiet
+        for a while is pinged first.
+        """
+        if self.failed or self.proc is None or self.proc.poll() is not None:
+            return False
+        if time.time() - self.last_response > self.idle_check:
+            try:
+                self.request('configure', {}, timeout=5)
+            except CompilerServerError:
+                return False
+        return True
+
+    def stop(self):
+        if self.proc is None:
+            return
+        print("Stopping compiler server for " + self.root)
+        try:
+            self.notify('exit')
+        except CompilerServerError:
+            pass
+        proc, self.proc = self.proc, None
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        # give it a moment to exit on its own
+        for i in range(10):
+            if proc.poll() is not None:
+                break
+            time.sleep(0.05)
+        else:
+            proc.kill()
+        self.devnull.close()
+        self._abort()
+
+    def set_project(self, source_file, options):
+        """
+        Put source_file in the server's external project, compiled with
+        options. tsserver leaves the files of an external project out of
+        the configured project of a tsconfig.json, so the plugin's compiler
+        options apply with or without one, the same as they do for tsc.
+        """
+        if options == self.options and source_file in self.project_files:
+            return
+        files = self.project_files | set([source_file])
+        self.request('openExternalProject', {'projectFileName': self.project_name,
+                                             'rootFiles': [{'fileName': name} for name in sorted(files)],
+                                             'options': options})
+        self.project_files = files
+        self.options = options
+
+    def compile(self, source_file, settings, out_dir=None, sourcemap=False, emit=True, text=None):
+        """
+        Check source_file and write its output to out_dir (next to the source
+        by default). Returns the same dict as _run.
+
+        With text, that is compiled in place of the file's content and the
+        output is returned as the "js" and "map" of the result instead of
+        being written.
+        """
+        in_memory = text is not None
+        with self.compile_lock:
+            self.timeout = settings.get('compilerServerTimeout', 30)
+            self.set_project(source_file, settings.compiler_options(sourcemap))
+            if not in_memory:
+                with open(source_file, encoding='utf-8') as f:
+                    text = f.read()
+            # an open file's text stands in for the disk until it is
+            # closed, so it is closed again right away: other compiles see
+            # the file as it is on disk. It stays in the project, which
+            # keeps its incremental state either way.
+            self.notify('open', {'file': source_file, 'fileContent': text, 'projectRootPath': self.root})
+            try:
+                diagnostics = self.request('syntacticDiagnosticsSync', {'file': source_file})
+                diagnostics += self.request('semanticDiagnosticsSync', {'file': source_file})
+                outputs = []
+                if emit:
+                    outputs = self.request('emit-output', {'file': source_file}).get('outputFiles', [])
+            finally:
+                self.notify('close', {'file': source_file})
+
+        diagnostics = [server_diagnostic(source_file, diagnostic) for diagnostic in diagnostics]
+        okay = not any(diagnostic["category"] == 'error' for diagnostic in diagnostics)
+        res = {"okay": okay, "out": "", "err": "\n".join(format_diagnostic(diagnostic) for diagnostic in diagnostics),
+               "diagnostics": diagnostics}
+        if in_memory:
+            res["js"] = res["map"] = ""
+            for output in outputs:
+                if output['name'].endswith('.js'):
+                    res["js"] = output['text']
+                elif output['name'].endswith('.js.map'):
+                    res["map"] = output['text']
+        else:
+            res["out"] = "\n".join(write_output(source_file, output['name'], output['text'], out_dir)
+                                   for output in outputs)
+        return res
+
+
+def server_diagnostic(source_file, diagnostic):
+    """
+    A tsserver diagnostic as the same dict DiagnosticStream parses out of
+    tsc output.
+    """
+    start = diagnostic.get('start', {'line': 1, 'offset': 1})
+    return {"file": source_file, "line": start['line'] - 1, "col": start['offset'] - 1,
+            "category": diagnostic.get('category', 'error'), "code": 'TS%s' % diagnostic.get('code', ''),
+            "message": diagnostic.get('text', '')}
+
+
+def format_diagnostic(diagnostic):
+    """
+    Format a diagnostic the way tsc prints it.
+    """
+    return '%s(%d,%d): %s %s: %s' % (diagnostic["file"], diagnostic["line"] + 1, diagnostic["col"] + 1,
+                                     diagnostic["category"], diagnostic["code"], diagnostic["message"])
+
+
+def first_error(res):
+    """
+    The first diagnostic of a compile result, or the first line it printed.
+    """
+    if res["diagnostics"]:
+        return format_diagnostic(res["diagnostics"][0])
+    return (res["err"] or res["out"]).split("\n")[0]
+
+
+def write_output(source_file, name, text, out_dir=None):
+    """
+    Write one emitted file into out_dir and return its path.
+    Source maps moved away from their source get their sources rewritten.
+    """
+    source_dir = os.path.dirname(source_file)
+    out_dir = out_dir or source_dir
+    output_path = os.path.join(out_dir, os.path.basename(name))
+    if name.endswith('.map') and os.path.normcase(out_dir) != os.path.normcase(source_dir):
+        smap = json.loads(text)
+        smap['sources'] = [os.path.relpath(source_file, out_dir).replace(os.sep, '/')]
+        smap['sourceRoot'] = ''
+        text = json.dumps(smap)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return output_path
+
+
+def find_program(program, search_path):
+    """
+    Full path of program in the os.pathsep separated search_path, or None.
+    """
+    for directory in search_path.split(os.pathsep):
+        candidate = os.path.join(directory.strip('"'), program)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+# source directory -> its project root, dropped when find_compiler sees a
+# project's package.json or node_modules change and when settings change
+project_roots = {}
+settings_listeners.append(project_roots.clear)
+
+
+def project_root(file_path):
+    """
+    The closest directory above file_path with a tsconfig.json or
+    package.json, else the file's own directory. Kept per directory in
+    project_roots.
+    """
+    source_dir = os.path.dirname(file_path)
+    root = project_roots.get(source_dir)
+    if root is not None:
+        return root
+    directory = source_dir
+    while True:
+        if any(os.path.isfile(os.path.join(directory, marker)) for marker in ('tsconfig.json', 'package.json')):
+            break
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            directory = source_dir
+            break
+        directory = parent
+    project_roots[source_dir] = directory
+    return directory
+
+
+compiler_servers = {}
+compiler_server_restarts = {}
+compiler_servers_lock = threading.Lock()
+
+
+def compiler_server(root, settings):
+    """
+    Return a healthy compiler server for root, starting or restarting one
+    when needed. None means the caller should use a one-shot tsc.
+    """
+    if not settings.get('compilerServer', True):
+        return None
+    with compiler_servers_lock:
+        server = compiler_servers.get(root)
+    if server is not None:
+        # pinging an idle server can take seconds, compiles of other roots
+        # don't wait for it
+        if server.healthy():
+            return server
+        with compiler_servers_lock:
+            if compiler_servers.get(root) is server:
+                del compiler_servers[root]
+            else:
+                # another compile already replaced it
+                server = None
+        if server is not None:
+            print("Compiler server for " + root + " is not responding, restarting")
+            server.stop()
+
+    with compiler_servers_lock:
+        server = compiler_servers.get(root)
+        if server is not None:
+            return server
+
+        # don't keep restarting a server that keeps dying
+        now = time.time()
+        restarts = [t for t in compiler_server_restarts.get(root, []) if now - t < 60]
+        if len(restarts) >= 3:
+            return None
+        restarts.append(now)
+        compiler_server_restarts[root] = restarts
+
+        executable = find_compiler(root, settings).tsserver
+        if executable is None:
+            return None
+        server = CompilerServer(root, [executable], env=settings.compiler_env)
+        try:
+            server.start()
+        except OSError as e:
+            print("Cannot start compiler server: " + str(e))
+            return None
+        compiler_servers[root] = server
+        return server
+
+
+def stop_compiler_servers():
+    with compiler_servers_lock:
+        for server in compiler_servers.values():
+            server.stop()
+        compiler_servers.clear()
+
+
+class CompileJob():
     """
-    Compile command
+    One scheduled compile. Cancelling it kills its tsc process, or the one
+    it starts later on.
     """
-    tempTSFile = path.join(tempfile.gettempdir(), "temp.ts")
-    with open(tempTSFile, 'w') as f:
-        f.write(source)
-    res = run("tsc", [tempTSFile])
-    res["out"] = open(path.join(tempfile.gettempdir(), 'temp.js')).read()
+
+    def __init__(self, key, work, callback, priority):
+        self.key = key
+        self.work = work
+        self.callback = callback
+        self.priority = priority
+        self.proc = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def attach(self, proc):
+        with self.lock:
+            self.proc = proc
+            if not self.cancelled:
+                return
+        proc.kill()
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return False
+            self.cancelled = True
+            proc = self.proc
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+        return True
+
+
+class CompileScheduler():
+    """
+    Runs at most one compile per key at a time, latest wins.
+
+    Submitting while a compile for the same key runs cancels the running
+    one (killing its tsc) and queues the new one to start once it exits.
+    A newer submission replaces a queued one, which counts as coalesced.
+    Results of cancelled compiles never reach their callback.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.queued = {}
+        self.coalesced = 0
+        self.cancelled = 0
+
+    def submit(self, key, work, callback, priority=PRIORITY_INTERACTIVE):
+        """
+        Call work(job) on the worker pool and callback(result) on success.
+        """
+        job = CompileJob(key, work, callback, priority)
+        with self.lock:
+            running = self.running.get(key)
+            if running is None:
+                self.running[key] = job
+            else:
+                if key in self.queued:
+                    self.coalesced += 1
+                self.queued[key] = job
+                if running.cancel():
+                    self.cancelled += 1
+                print("Compile superseded: %s (%d cancelled, %d coalesced so far)" % (
+                    key[-1], self.cancelled, self.coalesced))
+                return
+        self._start(job)
+
+    def _start(self, job):
+        run_async(lambda: self._execute(job), lambda result: self._done(job, result), job.priority)
+
+    def _execute(self, job):
+        if job.cancelled:
+            return None
+        # _done has to run whatever happens, or the key stays blocked
+        try:
+            return job.work(job)
+        except Exception:
+            traceback.print_exc()
+            return None
+
+    def _done(self, job, result):
+        with self.lock:
+            following = self.queued.pop(job.key, None)
+            if following is None:
+                del self.running[job.key]
+            else:
+                self.running[job.key] = following
+        if not job.cancelled and result is not None:
+            job.callback(result)
+        if following is not None:
+            self._start(following)
+
+    def stats(self):
+        with self.lock:
+            return {"running": len(self.running), "queued": len(self.queued),
+                    "cancelled": self.cancelled, "coalesced": self.coalesced}
+
+
+compile_scheduler = CompileScheduler()
+
+
+# Files a source pulls in: reference paths, and relative imports, exports
+# from, side effect and dynamic imports and requires
+DEPENDENCY_PATTERN = re.compile(r'''^\s*///\s*<reference\s+path\s*=\s*["']([^"']+)["']|'''
+                                r'''\bfrom\s+["'](\.[^"']+)["']|\bimport\s*\(?\s*["'](\.[^"']+)["']|'''
+                                r'''\brequire\(\s*["'](\.[^"']+)["']\s*\)''', re.M)
+
+class Compiler():
+    """
+    The tsc and tsserver a project compiles with. local tells whether they
+    come from its node_modules, stamp is what the choice depends on, see
+    project_stamp.
+    """
+
+    def __init__(self, tsc, tsserver, local, env, stamp):
+        self.tsc = tsc
+        self.tsserver = tsserver
+        self.local = local
+        self.env = env
+        self.stamp = stamp
+        self._version = None
+
+    @property
+    def version(self):
+        """
+        The output of tsc --version, asked on first use.
+        """
+        if self._version is None:
+            try:
+                proc = Popen([self.tsc, "--version"], env=self.env, stdout=PIPE, stderr=PIPE,
+                             shell=sys.platform == "win32")
+                self._version = proc.communicate()[0].decode('utf-8').strip()
+            except OSError:
+                self._version = "unknown"
+        return self._version
+
+
+def local_program(root, program):
+    """
+    The program in the node_modules/.bin closest above root, or None.
+    """
+    directory = root
+    while True:
+        candidate = os.path.join(directory, 'node_modules', '.bin', program)
+        if os.path.isfile(candidate):
+            return candidate
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def project_stamp(root, tsc=None):
+    """
+    Modification times of what decides the compiler of root: its
+    package.json and node_modules, and the node_modules of a local tsc
+    found further up.
+    """
+    paths = [os.path.join(root, 'package.json'), os.path.join(root, 'node_modules')]
+    if tsc is not None:
+        paths.append(os.path.dirname(os.path.dirname(tsc)))
+    stamp = []
+    for stamp_path in paths:
+        try:
+            stamp.append(os.stat(stamp_path).st_mtime)
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+# (project root, PATH) -> Compiler
+compilers = {}
+compilers_lock = threading.Lock()
+
+
+def find_compiler(root, settings):
+    """
+    The Compiler for the project at root: its own node_modules/.bin/tsc
+    (or the closest one above it) first, then tsc on the PATH built from
+    binDir and envPATH. Looked up once per root and PATH, again only once
+    package.json or node_modules change.
+    """
+    search_path = (settings.compiler_env or os.environ)["PATH"]
+    key = (root, search_path)
+    with compilers_lock:
+        compiler = compilers.get(key)
+    if compiler is not None:
+        if compiler.stamp == project_stamp(root, compiler.tsc if compiler.local else None):
+            return compiler
+        # a package.json that came or went may move the roots as well
+        project_roots.clear()
+
+    suffix = ".cmd" if sys.platform == "win32" else ""
+    tsc = local_program(root, "tsc" + suffix)
+    local = tsc is not None
+    if local:
+        tsserver = os.path.join(os.path.dirname(tsc), "tsserver" + suffix)
+        if not os.path.isfile(tsserver):
+            tsserver = None
+    else:
+        # the bare name still goes through the shell's own lookup on Windows
+        tsc = find_program("tsc" + suffix, search_path) or "tsc"
+        tsserver = find_program("tsserver" + suffix, search_path)
+    print("Compiler for %s: %s" % (root, tsc))
+    compiler = Compiler(tsc, tsserver, local, settings.compiler_env, project_stamp(root, tsc if local else None))
+    with compilers_lock:
+        compilers[key] = compiler
+    return compiler
+
+
+def tsc_for(source_file, settings):
+    """
+    The tsc command to compile source_file with.
+    """
+    return find_compiler(project_root(source_file), settings).tsc
+
+
+class CompileCache():
+    """
+    Results of earlier compiles, keyed on a hash of everything that goes
+    into one: the source bytes, every file it pulls in through reference
+    paths and relative imports, directly or through other files (by mtime
+    and size), the project's package.json, node_modules and
+    node_modules/@types, where other imports and ambient declarations
+    resolve, and its tsconfig.json, the compiler flags and output
+    options and the compiler version. A hit writes the emitted .js and
+    .js.map back and returns the stored diagnostics without starting tsc.
+    The least recently used entries go once the stored text passes budget
+    bytes. Compiles of unsaved text are keyed on the text instead and keep
+    their "js" and "map" in the result.
+    """
+
+    def __init__(self, budget=32 << 20):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # path -> (mtime, size, the dependencies named in the file)
+        self.imports = {}
+
+    def key(self, source_file, settings, out_dir, sourcemap, emit, text=None):
+        if text is None:
+            with open(source_file, 'rb') as f:
+                source = f.read()
+        else:
+            source = text.encode('utf-8')
+        digest = hashlib.sha1(source)
+        for dependency in sorted(self.dependencies(source_file, source)):
+            digest.update(('%s %r %d\n' % dependency).encode('utf-8'))
+        root = project_root(source_file)
+        # tsc takes in node_modules/@types by itself, the only ambient
+        # declarations that come without a reference
+        stamps = []
+        for stamp_path in ('tsconfig.json', os.path.join('node_modules', '@types')):
+            try:
+                stat = os.stat(os.path.join(root, stamp_path))
+                stamps.append([stat.st_mtime, stat.st_size])
+            except OSError:
+                stamps.append(None)
+        options = [find_compiler(root, settings).version, project_stamp(root), stamps, out_dir or '',
+                   sourcemap, emit, text is not None] + settings.compiler_args
+        digest.update(json.dumps(options).encode('utf-8'))
+        return source_file, digest.hexdigest()
+
+    def dependencies(self, source_file, source):
+        """
+        The (path, mtime, size) of every file source_file pulls in, directly
+        or through other files, source being its content. The others are
+        read again only once their mtime or size change.
+        """
+        found = []
+        seen = set([source_file])
+        pending = [(source_file, self.parse(source))]
+        while pending:
+            current, names = pending.pop()
+            directory = os.path.dirname(current)
+            for name in names:
+                dependency = os.path.join(directory, name)
+                for candidate in (dependency, dependency + '.ts', dependency + '.tsx', dependency + '.d.ts',
+                                  os.path.join(dependency, 'index.ts'), os.path.join(dependency, 'index.d.ts')):
+                    if os.path.isfile(candidate):
+                        candidate = os.path.normpath(candidate)
+                        if candidate not in seen:
+                            seen.add(candidate)
+                            stat = os.stat(candidate)
+                            found.append((candidate, stat.st_mtime, stat.st_size))
+                            pending.append((candidate, self.file_imports(candidate, stat)))
+                        break
+        return found
+
+    def file_imports(self, file_path, stat):
+        entry = self.imports.get(file_path)
+        if entry is None or entry[:2] != (stat.st_mtime, stat.st_size):
+            with open(file_path, 'rb') as f:
+                entry = self.imports[file_path] = (stat.st_mtime, stat.st_size, self.parse(f.read()))
+        return entry[2]
+
+    def parse(self, source):
+        return [next(group for group in match.groups() if group)
+                for match in DEPENDENCY_PATTERN.finditer(source.decode('utf-8', 'replace'))]
+
+    def restore(self, key):
+        """
+        Write back the outputs of a cached compile and return its result,
+        or None on a miss.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        result, outputs, size = entry
+        for output_path, text in outputs:
+            try:
+                with open(output_path, encoding='utf-8') as f:
+                    if f.read() == text:
+                        continue
+            except (IOError, OSError):
+                pass
+            with open(output_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        return dict(result)
+
+    def store(self, key, result, output_paths):
+        outputs = []
+        for output_path in output_paths:
+            try:
+                with open(output_path, encoding='utf-8') as f:
+                    outputs.append((output_path, f.read()))
+            except (IOError, OSError):
+                continue
+        size = sum(len(text) for output_path, text in outputs) + sum(len(result.get(name) or '')
+                                                                     for name in ("out", "err", "js", "map"))
+        with self.lock:
+            self._discard(key)
+            if size > self.budget:
+                return
+            self.entries[key] = (dict(result), outputs, size)
+            self.used += size
+            while self.used > self.budget:
+                self._discard(next(iter(self.entries)))
+
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.used -= entry[2]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+                    "entries": len(self.entries), "bytes": self.used}
+
+
+compile_cache = CompileCache()
+
+
+def output_paths(source_file, out_dir=None, sourcemap=False):
+    """
+    Where tsc writes the output of source_file.
+    """
+    name = os.path.splitext(os.path.basename(source_file))[0] + '.js'
+    js_file = os.path.join(out_dir or os.path.dirname(source_file), name)
+    return [js_file, js_file + '.map'] if sourcemap else [js_file]
+
+
+def compile_file(source_file, out_dir=None, sourcemap=False, emit=True, cwd=None, callback=None, key=None,
+                 priority=PRIORITY_INTERACTIVE, settings=None, on_diagnostics=None):
+    """
+    Compile a single file. Goes through the project's compiler server when
+    there is one and falls back to a one-shot tsc otherwise.
+    Will run on thread if callback function is passed. With a key as well,
+    it goes through compile_scheduler: a later compile_file call with the
+    same key supersedes this one.
+    on_diagnostics gets the diagnostics in batches, on the compiling
+    thread, while tsc still runs.
+    """
+    # resolved here, on the calling thread, for the whole compile
+    settings = settings or current_settings()
+    if callback and key is not None:
+        compile_scheduler.submit(key, lambda job: _compile_file(source_file, settings, out_dir, sourcemap, emit, cwd,
+                                                                job, on_diagnostics),
+                                 callback, priority)
+    elif callback:
+        run_async(lambda: _compile_file(source_file, settings, out_dir, sourcemap, emit, cwd,
+                                        on_diagnostics=on_diagnostics), callback, priority)
+    else:
+        return _compile_file(source_file, settings, out_dir, sourcemap, emit, cwd, on_diagnostics=on_diagnostics)
+
+
+def _compile_file(source_file, settings, out_dir=None, sourcemap=False, emit=True, cwd=None, job=None,
+                  on_diagnostics=None):
+    if not settings.get('compileCache', True):
+        return _compile_uncached(source_file, settings, out_dir, sourcemap, emit, cwd, job, on_diagnostics)
+
+    compile_cache.budget = settings.get('compileCacheSize', 32) << 20
+    with timings.span('compile cache', source_file):
+        key = compile_cache.key(source_file, settings, out_dir, sourcemap, emit)
+        res = compile_cache.restore(key)
+    if res is None:
+        res = _compile_uncached(source_file, settings, out_dir, sourcemap, emit, cwd, job, on_diagnostics)
+        if job is None or not job.cancelled:
+            compile_cache.store(key, res, output_paths(source_file, out_dir, sourcemap) if emit else [])
+    elif on_diagnostics is not None and res["diagnostics"]:
+        on_diagnostics(res["diagnostics"])
+    return res
+
+
+def _compile_uncached(source_file, settings, out_dir=None, sourcemap=False, emit=True, cwd=None, job=None,
+                      on_diagnostics=None):
+    server = compiler_server(project_root(source_file), settings)
+    if server is not None:
+        try:
+            with timings.span('compiler server', source_file):
+                res = server.compile(source_file, settings, out_dir=out_dir, sourcemap=sourcemap, emit=emit)
+            if on_diagnostics is not None and res["diagnostics"]:
+                on_diagnostics(res["diagnostics"])
+            return res
+        except CompilerServerError as e:
+            print("Compiler server failed, falling back to tsc: " + str(e))
+
+    args = [source_file]
+    if sourcemap:
+        args = ['--sourcemap'] + args
+    if not emit:
+        out_dir = tempfile.gettempdir()
+    if out_dir:
+        args = ['--outDir', out_dir] + args
+    return _run(tsc_for(source_file, settings), args, cwd=cwd, job=job, settings=settings,
+                on_diagnostics=on_diagnostics)
+
+
+def buffer_path(view):
+    """
+    The path a view's text is compiled as: its file, or a made up one in
+    the temp directory for a buffer that was never saved.
+    """
+    return view.file_name() or path.join(tempfile.gettempdir(), 'untitled-%d.ts' % view.id())
+
+
+def compile_text(source_file, text, sourcemap=False, emit=True, callback=None, key=None,
+                 priority=PRIORITY_INTERACTIVE, settings=None):
+    """
+    Compile unsaved text as if it were the content of source_file. Nothing
+    is written next to the source: the result carries the compiled "js"
+    and "map" text next to okay/out/err.
+    Runs like compile_file, on the worker pool if a callback is passed.
+    """
+    settings = settings or current_settings()
+    if callback and key is not None:
+        compile_scheduler.submit(key, lambda job: _compile_text(source_file, text, settings, sourcemap, emit, job),
+                                 callback, priority)
+    elif callback:
+        run_async(lambda: _compile_text(source_file, text, settings, sourcemap, emit), callback, priority)
+    else:
+        return _compile_text(source_file, text, settings, sourcemap, emit)
+
+
+def _compile_text(source_file, text, settings, sourcemap=False, emit=True, job=None):
+    if not settings.get('compileCache', True):
+        return _compile_text_uncached(source_file, text, settings, sourcemap, emit, job)
+
+    compile_cache.budget = settings.get('compileCacheSize', 32) << 20
+    with timings.span('compile cache', source_file):
+        key = compile_cache.key(source_file, settings, None, sourcemap, emit, text=text)
+        res = compile_cache.restore(key)
+    if res is None:
+        res = _compile_text_uncached(source_file, text, settings, sourcemap, emit, job)
+        if job is None or not job.cancelled:
+            compile_cache.store(key, res, [])
     return res
 
 
+def _compile_text_uncached(source_file, text, settings, sourcemap=False, emit=True, job=None):
+    server = compiler_server(project_root(source_file), settings)
+    if server is not None:
+        try:
+            with timings.span('compiler server', source_file):
+                return server.compile(source_file, settings, sourcemap=sourcemap, emit=emit, text=text)
+        except CompilerServerError as e:
+            print("Compiler server failed, falling back to tsc: " + str(e))
+
+    # tsc has no stdin input, so the text goes to a file of its own in the
+    # temp directory, or with compileTextBesideSource to a hidden one
+    # beside source_file, where its relative imports resolve the same
+    out_dir = tempfile.mkdtemp(prefix='better-typescript-')
+    name, extension = path.splitext(path.basename(source_file))
+    prefix = '.%s.better-typescript-' % name
+    fd = None
+    if settings.get('compileTextBesideSource', False):
+        try:
+            fd, temp_file = tempfile.mkstemp(extension or '.ts', prefix, path.dirname(source_file))
+        except (IOError, OSError):
+            pass
+    if fd is None:
+        fd, temp_file = tempfile.mkstemp(extension or '.ts', prefix, out_dir)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        args = ['--outDir', out_dir, temp_file]
+        if sourcemap:
+            args = ['--sourcemap'] + args
+        res = _run(tsc_for(source_file, settings), args, cwd=path.dirname(temp_file), job=job, settings=settings,
+                   label=source_file)
+        # report against the buffer's own path
+        temp_name = path.basename(temp_file)
+        for key in ("out", "err"):
+            res[key] = res[key].replace(temp_file, source_file).replace(temp_name, path.basename(source_file))
+        for diagnostic in res["diagnostics"]:
+            if diagnostic["file"] == temp_file:
+                diagnostic["file"] = source_file
+        # the output lands deeper in out_dir when imports outside the
+        # directory move tsc's common root up
+        js_name = path.basename(output_paths(temp_file)[0])
+        source_js = path.basename(output_paths(source_file)[0])
+        js_file = next((path.join(directory, js_name) for directory, _, files in os.walk(out_dir)
+                        if js_name in files), path.join(out_dir, js_name))
+        for key, output_path in zip(("js", "map"), (js_file, js_file + '.map')):
+            try:
+                with open(output_path, encoding='utf-8') as f:
+                    res[key] = f.read()
+            except (IOError, OSError):
+                res[key] = ""
+        res["js"] = res["js"].replace(js_name, source_js)
+        if res["map"]:
+            smap = json.loads(res["map"])
+            smap["file"] = source_js
+            smap["sources"] = [path.basename(source_file)]
+            res["map"] = json.dumps(smap, separators=(',', ':'))
+        return res
+    finally:
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def plugin_loaded():
+    timings.configure()
+    worker_pool.configure()
+
+
+def plugin_unloaded():
+    stop_compiler_servers()
+
+
 def isTypescript(view=None):
     if view is None:
         view = sublime.active_window().active_view()
@@ -193,12 +1562,163 @@ class Text():
         return Text.all(view)
 
 
+# scope and gutter icon of each diagnostic category
+DIAGNOSTIC_STYLES = {
+    'error': ('invalid', 'circle'),
+    'warning': ('invalid.deprecated', 'dot'),
+    'message': ('comment', 'dot'),
+    'suggestion': ('comment', 'dot'),
+}
+# squiggles need Sublime Text 3 build 3080 or later
+DIAGNOSTIC_FLAGS = getattr(sublime, 'DRAW_SQUIGGLY_UNDERLINE', sublime.DRAW_SOLID_UNDERLINE) | \
+    sublime.DRAW_NO_FILL | sublime.DRAW_NO_OUTLINE
+
+# normcased file -> its diagnostics from the last compile that reported on it
+file_diagnostics = {}
+# view id -> DiagnosticRegions
+diagnostic_regions = {}
+region_ids = itertools.count()
+
+
+class DiagnosticRegions():
+    """
+    The diagnostics drawn in one view as gutter icons and underlines.
+
+    Each diagnostic has a region key of its own, so a redraw leaves the
+    ones that did not change alone: a diagnostic is unchanged when its
+    region, which Sublime moves along with edits, still starts where the
+    compiler now reports it. at() finds the diagnostics at a point through
+    an interval index of the current regions, rebuilt after edits.
+    """
+
+    def __init__(self, view):
+        self.view = view
+        # region key -> diagnostic
+        self.keys = OrderedDict()
+        self.starts = None
+        self.extents = None
+        self.longest = 0
+
+    def draw(self, diagnostics):
+        view = self.view
+        current = {}
+        for key, diagnostic in self.keys.items():
+            regions = view.get_regions(key)
+            if regions:
+                current[self.identity(diagnostic, regions[0].begin())] = key
+
+        keys = OrderedDict()
+        for diagnostic in diagnostics:
+            point = view.text_point(diagnostic["line"], diagnostic["col"])
+            key = current.pop(self.identity(diagnostic, point), None)
+            if key is None:
+                key = 'typescript-diagnostic-%d' % next(region_ids)
+                scope, icon = DIAGNOSTIC_STYLES.get(diagnostic["category"], DIAGNOSTIC_STYLES['error'])
+                view.add_regions(key, [self.extent(point)], scope, icon, DIAGNOSTIC_FLAGS)
+            keys[key] = diagnostic
+        for key in self.keys:
+            if key not in keys:
+                view.erase_regions(key)
+        self.keys = keys
+        self.starts = None
+
+    def identity(self, diagnostic, point):
+        return diagnostic["category"], diagnostic["code"], diagnostic["message"], point
+
+    def extent(self, point):
+        """
+        The word at point, or the character at point when there is none.
+        """
+        word = self.view.word(point)
+        if word.begin() == point and not word.empty() and '\n' not in self.view.substr(word):
+            return word
+        return sublime.Region(point, min(point + 1, self.view.line(point).end()))
+
+    def modified(self):
+        self.starts = None
+
+    def at(self, point):
+        """
+        The diagnostics whose regions contain point.
+        """
+        if self.starts is None:
+            extents = []
+            for key, diagnostic in self.keys.items():
+                regions = self.view.get_regions(key)
+                if regions:
+                    extents.append((regions[0].begin(), regions[0].end(), diagnostic))
+            extents.sort(key=lambda extent: extent[:2])
+            self.extents = extents
+            self.starts = [extent[0] for extent in extents]
+            self.longest = max([end - begin for begin, end, diagnostic in extents] or [0])
+        found = []
+        # only regions starting within the longest extent before point can reach it
+        i = bisect_right(self.starts, point)
+        while i > 0 and self.starts[i - 1] >= point - self.longest:
+            i -= 1
+            begin, end, diagnostic = self.extents[i]
+            if point <= end:
+                found.append(diagnostic)
+        found.reverse()
+        return found
+
+    def clear(self):
+        for key in self.keys:
+            self.view.erase_regions(key)
+        self.keys = OrderedDict()
+        self.starts = None
+
+
+def draw_diagnostics(view, diagnostics):
+    """
+    Show diagnostics in view, replacing those drawn before. Main thread only.
+    """
+    regions = diagnostic_regions.get(view.id())
+    if not current_settings(view).get('inlineDiagnostics', True):
+        if regions is not None:
+            regions.clear()
+        return
+    if regions is None:
+        regions = diagnostic_regions[view.id()] = DiagnosticRegions(view)
+    regions.draw(diagnostics)
+
+
+def update_diagnostics(diagnostics, files=()):
+    """
+    Keep the diagnostics of a compile of files, and of any other file they
+    are about, and redraw them in the views of those files. Main thread
+    only.
+    """
+    by_file = dict((os.path.normcase(source_file), []) for source_file in files)
+    for diagnostic in diagnostics:
+        by_file.setdefault(os.path.normcase(diagnostic["file"]), []).append(diagnostic)
+    file_diagnostics.update(by_file)
+    for window in sublime.windows():
+        for view in window.views():
+            file_name = view.file_name()
+            if file_name and os.path.normcase(file_name) in by_file:
+                draw_diagnostics(view, by_file[os.path.normcase(file_name)])
+
+
+def draw_buffer_diagnostics(view, result):
+    """
+    Show the diagnostics of a compile_text of view's buffer in it. Can be
+    called from any thread.
+    """
+    source_file = os.path.normcase(buffer_path(view))
+    diagnostics = [diagnostic for diagnostic in result["diagnostics"]
+                   if os.path.normcase(diagnostic["file"]) == source_file]
+    sublime.set_timeout(lambda: draw_diagnostics(view, diagnostics), 0)
+
+
 def popup_error_list(view, error_list):
 
     panel_items = []
+    # one read of the buffer instead of one per error
+    lines = view.substr(sublime.Region(0, view.size())).split('\n')
 
     for error in error_list:
-        line_text = view.substr(view.full_line(view.text_point(error['line'], 0)))
+        line_text = lines[error['line']] if error['line'] < len(lines) else ''
         item = [error['message'], '{0}: {1}'.format(error['line'] + 1, line_text.strip())]
         panel_items.append(item)
 
@@ -221,75 +1741,148 @@ def popup_error_list(view, error_list):
     view.window().show_quick_panel(panel_items, on_done)
 
 
-class CompileCodeCommand(TextCommand):
-    def is_enabled(self):
-        return isTypescript(self.view)
+def split_path(directory):
+    parts = os.path.normpath(os.path.normcase(directory)).split(os.sep)
+    # a root keeps its separator through normpath, '/' would split to ['', '']
+    while len(parts) > 1 and not parts[-1]:
+        parts.pop()
+    return parts
+
+
+class CompilePathTrie():
+    """
+    The compilePaths roots in a trie of their path components, so the
+    closest root of a directory is found in time proportional to the
+    depth of the directory rather than the number of roots.
+    """
 
-    def on_done(self, result):
-        if result['okay'] is True:
-            status = 'Compilation Succeeded'
+    def __init__(self, compile_paths):
+        self.root = {}
+        for key_path in compile_paths:
+            node = self.root
+            for part in split_path(key_path):
+                node = node.setdefault(part, {})
+            # None marks the end of a root, the first of equal roots wins
+            node.setdefault(None, (os.path.normcase(key_path), compile_paths[key_path]))
+
+    def match(self, directory):
+        """
+        The (root, target, appendix) of the deepest root that contains
+        directory, appendix being the way from the root down to it, or
+        None when no root does.
+        """
+        parts = split_path(directory)
+        node = self.root
+        found = None
+        for depth, part in enumerate(parts):
+            if None in node:
+                found = node[None], depth
+            node = node.get(part)
+            if node is None:
+                break
         else:
-            status = 'Compilation FAILED '
-            error_list = []
-            print(result["err"])
-            for line in result["err"].split('\n'):
-                if len(line.split(":")) < 3:
-                    continue
-                try:
-                    message = line.split(":")[2]
-                    lineNum = line.split("(")[1].split(",")[0]
-                    rowNum = line.split("(")[1].split(",")[1].split(")")[0]
-                except:
-                    print("Cannot parse: " + line)
-                    continue
-                try:
-                    error_list.append({"message": message, "line": int(lineNum)-1, "col": int(rowNum)})
-                except:
-                    continue
-            if len(error_list):
-                popup_error_list(self.view, error_list)
+            if None in node:
+                found = node[None], len(parts)
+        if found is None:
+            return None
+        (root, target), depth = found
+        return root, target, os.path.join(*parts[depth:]) if depth < len(parts) else '.'
 
-        later = lambda: sublime.status_message(status)
-        sublime.set_timeout(later, 300)
 
-    def run(self, *args, **kwargs):
-        # no_wrapper = settings_get('noWrapper', True)
-        compile_dir = settings_get('compileDir')
-        source_file = self.view.file_name()
-        source_dir = os.path.normcase(os.path.dirname(source_file))
-        compile_paths = settings_get('compilePaths')
-        sourcemaps = settings_get('sourceMaps', True)
-        args = [source_file]
-        if sourcemaps:
-            args = ['--sourcemap'] + args
+# output directories known to exist, forgotten when settings change
+output_dirs_created = set()
+settings_listeners.append(output_dirs_created.clear)
+
 
-        # check instance of compile_paths
-        if isinstance(compile_paths, dict):
-            appendix_len = None
-            for key_path in compile_paths:
-                norm_path = os.path.normcase(key_path)
-                appendix = os.path.relpath(source_dir, norm_path)
-                if not appendix.startswith('..') and (appendix_len is None or len(appendix) < appendix_len):
-                    appendix_len = len(appendix)
-                    compile_dir = compile_paths[key_path]
-                    if not os.path.isabs(compile_dir):
-                        compile_dir = os.path.join(norm_path, compile_dir)
-                    compile_dir = os.path.join(compile_dir, appendix)
-
-        if compile_dir and (isinstance(compile_dir, str)):
-            # Check for absolute path or relative path for compile_dir
+def output_dir(source_dir, settings):
+    """
+    The directory tsc writes the output of the files in source_dir to,
+    following compileDir and compilePaths, or None to write it next to
+    them. Creates the directory if needed. Results are kept per source
+    directory in the settings snapshot.
+    """
+    try:
+        return settings.output_dirs[source_dir]
+    except KeyError:
+        pass
+
+    compile_dir = settings.get('compileDir')
+    compile_paths = settings.get('compilePaths')
+    out_dir = None
+
+    # check instance of compile_paths
+    if isinstance(compile_paths, dict):
+        if settings.compile_path_trie is None:
+            settings.compile_path_trie = CompilePathTrie(compile_paths)
+        match = settings.compile_path_trie.match(source_dir)
+        if match is not None:
+            norm_path, compile_dir, appendix = match
             if not os.path.isabs(compile_dir):
-                compile_dir = os.path.join(source_dir, compile_dir)
-            print("Compile to:" + compile_dir)
-            # create folder if not exist
+                compile_dir = os.path.join(norm_path, compile_dir)
+            compile_dir = os.path.join(compile_dir, appendix)
+
+    if compile_dir and (isinstance(compile_dir, str)):
+        # Check for absolute path or relative path for compile_dir
+        if not os.path.isabs(compile_dir):
+            compile_dir = os.path.join(source_dir, compile_dir)
+        print("Compile to:" + compile_dir)
+        # create folder if not exist
+        if compile_dir not in output_dirs_created:
             if not os.path.exists(compile_dir):
                 os.makedirs(compile_dir)
                 print("Compile dir did not exist, created folder: " + compile_dir)
-            folder, file_nm = os.path.split(source_file)
-            args = ['--outDir', compile_dir] + args
-        else:
-            compile_dir = source_dir
-            print("Compile to same directory")
+            output_dirs_created.add(compile_dir)
+        out_dir = compile_dir
+    else:
+        print("Compile to same directory")
+
+    settings.output_dirs[source_dir] = out_dir
+    return out_dir
+
+
+def report_compile(view, result, popup=True):
+    """
+    Show how the compile of view's file went: its diagnostics in the
+    buffer, and in a list too unless popup is False and inlineDiagnostics
+    marks them in the buffer already.
+    """
+    sublime.set_timeout(lambda: update_diagnostics(result["diagnostics"], [view.file_name()]), 0)
+    if result['okay'] is True:
+        status = 'Compilation Succeeded'
+    else:
+        status = 'Compilation FAILED '
+        print(result["err"] or result["out"])
+        if result["diagnostics"] and (popup or not current_settings(view).get('inlineDiagnostics', True)):
+            popup_error_list(view, result["diagnostics"])
+
+    later = lambda: sublime.status_message(status)
+    sublime.set_timeout(later, 300)
+
+
+class CompileCodeCommand(TextCommand):
+    def is_enabled(self):
+        return isTypescript(self.view)
+
+    def on_done(self, result, background=False):
+        # compiles on save leave it at the marks in the buffer, if they are on
+        report_compile(self.view, result, popup=not background)
+
+    def on_diagnostics(self, count, batch):
+        """
+        Show the diagnostics found so far while the compile still runs.
+        """
+        count[0] += len(batch)
+        status = 'Compiling: %d error%s so far, %s' % (count[0], '' if count[0] == 1 else 's',
+                                                     format_diagnostic(batch[0]))
+        sublime.set_timeout(lambda: sublime.status_message(status), 0)
+
+    def run(self, *args, **kwargs):
+        settings = current_settings(self.view)
+        # no_wrapper = settings.get('noWrapper', True)
+        source_file = self.view.file_name()
+        source_dir = os.path.normcase(os.path.dirname(source_file))
+        sourcemaps = settings.get('sourceMaps', True)
+        out_dir = output_dir(source_dir, settings)
 
         if sourcemaps:
             cwd = source_dir
@@ -297,7 +1890,104 @@ class CompileCodeCommand(TextCommand):
             cwd = None
         later = lambda: sublime.status_message("Compiling")
         sublime.set_timeout(later, 300)
-        run("tsc", args, cwd=cwd, callback=lambda res: self.on_done(res))
+        # compile on save runs behind interactive work like watch refreshes
+        priority = PRIORITY_BACKGROUND if kwargs.get('background') else PRIORITY_INTERACTIVE
+        compile_file(source_file, out_dir=out_dir, sourcemap=sourcemaps, cwd=cwd,
+                     callback=lambda res: self.on_done(res, kwargs.get('background', False)),
+                     key=('compile', source_file), priority=priority,
+                     settings=settings, on_diagnostics=functools.partial(self.on_diagnostics, [0]))
+
+
+def compile_batch(files, out_dir, sourcemap, settings):
+    """
+    Compile files that share their output options with a single tsc.
+    Through a compiler server they go one by one, the server already
+    shares what the files have in common.
+    """
+    if compiler_server(project_root(files[0]), settings) is not None:
+        results = [_compile_file(source_file, settings, out_dir, sourcemap) for source_file in files]
+        return {"okay": all(res["okay"] for res in results),
+                "out": "\n".join(res["out"] for res in results if res["out"]),
+                "err": "\n".join(res["err"] for res in results if res["err"]),
+                "diagnostics": [diagnostic for res in results for diagnostic in res["diagnostics"]]}
+
+    args = list(files)
+    if sourcemap:
+        args = ['--sourcemap'] + args
+    if out_dir:
+        args = ['--outDir', out_dir] + args
+    return _run(tsc_for(files[0], settings), args, cwd=os.path.dirname(files[0]) if sourcemap else None,
+                settings=settings)
+
+
+class SaveBatcher():
+    """
+    Collects compile on save requests for compileOnSaveDelay milliseconds,
+    so a Save All compiles the files that share an output configuration
+    (output directory, source maps, compiler flags and compiler) with one
+    tsc instead of one each. With an output directory only files of the
+    same directory share a tsc, see build_shards. Diagnostics are routed back to the view of
+    their file. Only used from the main thread.
+    """
+
+    def __init__(self):
+        self.groups = OrderedDict()
+        self.scheduled = False
+
+    def add(self, view, settings):
+        source_file = view.file_name()
+        sourcemap = settings.get('sourceMaps', True)
+        source_dir = os.path.normcase(os.path.dirname(source_file))
+        out_dir = output_dir(source_dir, settings)
+        # the tsc of the project, files of projects with a tsc of their own
+        # never share a run
+        tsc = find_compiler(project_root(source_file), settings).tsc
+        key = (out_dir, source_dir if out_dir else None, sourcemap, tuple(settings.compiler_args), tsc,
+               settings.get('binDir'), settings.get('envPATH'))
+        if key not in self.groups:
+            self.groups[key] = (settings, OrderedDict())
+        self.groups[key][1][source_file] = view
+        if not self.scheduled:
+            self.scheduled = True
+            sublime.set_timeout(self.flush, settings.get('compileOnSaveDelay', 200))
+
+    def flush(self):
+        groups, self.groups, self.scheduled = self.groups, OrderedDict(), False
+        for (out_dir, source_dir, sourcemap, args, tsc, bin_dir, env_path), (settings, views) in groups.items():
+            if len(views) == 1:
+                for view in views.values():
+                    view.run_command("compile_code", {"background": True})
+                continue
+            print("Compiling %d saved files together" % len(views))
+            run_async(functools.partial(compile_batch, list(views), out_dir, sourcemap, settings),
+                      functools.partial(self.on_done, views), PRIORITY_BACKGROUND)
+
+    def on_done(self, views, result):
+        batch = set(os.path.normcase(source_file) for source_file in views)
+        by_file = {}
+        # diagnostics in files outside the batch, like a shared .d.ts, concern all of them
+        shared = []
+        for diagnostic in result["diagnostics"]:
+            source_file = os.path.normcase(diagnostic["file"])
+            if source_file in batch:
+                by_file.setdefault(source_file, []).append(diagnostic)
+            else:
+                shared.append(diagnostic)
+
+        def route():
+            for source_file, view in views.items():
+                if not view.is_valid():
+                    continue
+                diagnostics = by_file.get(os.path.normcase(source_file), []) + shared
+                # a failed run without any diagnostics fails every file
+                okay = result["okay"] or (bool(result["diagnostics"]) and
+                                          not any(d["category"] == 'error' for d in diagnostics))
+                report_compile(view, {"okay": okay, "out": result["out"], "err": result["err"],
+                                      "diagnostics": diagnostics}, popup=False)
+        sublime.set_timeout(route, 0)
+
+
+save_batcher = SaveBatcher()
 
 
 class CompileAndDisplayCodeCommand(TextCommand):
@@ -305,19 +1995,21 @@ class CompileAndDisplayCodeCommand(TextCommand):
         return isTypescript(self.view)
 
     def on_done(self, res, output):
+        output = self.view.window().new_file()
+        output.set_scratch(True)
+        output.set_name(Tool.get_js_file_name(Tool.get_file_name(self.view.file_name())))
+        output.set_syntax_file('Packages/JavaScript/JavaScript.tmLanguage')
+        output.run_command('update_watch', {'pos': 0, 'text': res["js"] or res["out"] or res["err"]})
+        draw_buffer_diagnostics(self.view, res)
         if res["okay"] is True:
-            self.view.window().open_file(self.view.file_name().split(".")[0]+'.js')
-        else:
-            output = self.view.window().new_file()
-            output.set_scratch(True)
-            output.set_syntax_file('Packages/JavaScript/JavaScript.tmLanguage')
-            output.run_command('update_watch', {'pos': 0, 'text': res["out"] or res["err"]})
             sublime.status_message("Compiling done.")
+        else:
+            sublime.status_message(first_error(res))
 
     def run(self, edit, **kwargs):
         sublime.status_message("Compiling typescript...")
-        args = [self.view.file_name()]
-        run("tsc", args, callback=lambda res: self.on_done(res, edit))
+        compile_text(buffer_path(self.view), Text.all(self.view), callback=lambda res: self.on_done(res, edit),
+                     settings=current_settings(self.view))
 
 
 class CheckCodeSyntaxCommand(TextCommand):
@@ -325,27 +2017,255 @@ class CheckCodeSyntaxCommand(TextCommand):
         return isTypescript(self.view)
 
     def on_done(self, res):
+        draw_buffer_diagnostics(self.view, res)
         if res["okay"] is True:
             status = 'Valid'
         else:
-            status = res["err"].split("\n")[0]
+            status = first_error(res)
         sublime.message_dialog('Syntax %s' % status)
         # sublime.status_message()
 
     def run(self, edit):
         sublime.status_message("Checking syntax...")
-        args = [self.view.file_name(), "--outDir", tempfile.gettempdir()]
-        run("tsc", args, callback=lambda res: self.on_done(res))
+        compile_text(buffer_path(self.view), Text.all(self.view), emit=False, callback=lambda res: self.on_done(res),
+                     settings=current_settings(self.view))
+
+
+def project_sources(roots):
+    """
+    Every .ts file under roots, leaving out declaration files,
+    node_modules and hidden folders. Each file comes up once, a root
+    inside another root is walked on its own only.
+    """
+    roots = OrderedDict((os.path.normcase(os.path.normpath(root)), root) for root in roots)
+    sources = []
+    for root in roots.values():
+        for directory, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(name for name in dirnames if name != 'node_modules' and not name.startswith('.') and
+                                 os.path.normcase(os.path.normpath(os.path.join(directory, name))) not in roots)
+            sources.extend(os.path.join(directory, name) for name in sorted(filenames)
+                           if name.endswith('.ts') and not name.endswith('.d.ts'))
+    return sources
+
+
+def build_shards(sources, settings, workers):
+    """
+    Split sources into (out_dir, files) shards that each compile with one
+    tsc. Files only share a shard when their output goes to the same
+    directory, a shard holds at most buildShardSize files, or an even
+    share of them per worker when that is 0. With an output directory
+    they also come from the same directory, tsc lays out --outDir after
+    the common root of the files it is given.
+    """
+    out_dirs = {}
+    groups = OrderedDict()
+    for source_file in sources:
+        source_dir = os.path.normcase(os.path.dirname(source_file))
+        if source_dir not in out_dirs:
+            out_dirs[source_dir] = output_dir(source_dir, settings)
+        out_dir = out_dirs[source_dir]
+        groups.setdefault((out_dir, source_dir if out_dir else None), []).append(source_file)
+
+    size = settings.get('buildShardSize', 0) or max(1, -(-len(sources) // workers))
+    shards = []
+    for (out_dir, _), files in groups.items():
+        shards.extend((out_dir, files[i:i + size]) for i in range(0, len(files), size))
+    return shards
+
+
+class BuildProjectCommand(WindowCommand):
+    """
+    Compiles every .ts file under the compilePaths roots, or the window's
+    folders without them, in shards that run in parallel on the worker
+    pool. The merged diagnostics and the timings of the build and of
+    every shard go to the "TypeScript Build" output panel.
+    """
+
+    def is_enabled(self):
+        return bool(self.roots(current_settings(self.window.active_view())))
+
+    def roots(self, settings):
+        compile_paths = settings.get('compilePaths')
+        if isinstance(compile_paths, dict) and compile_paths:
+            return sorted(compile_paths)
+        return self.window.folders()
+
+    def run(self):
+        settings = current_settings(self.window.active_view())
+        sources = project_sources(self.roots(settings))
+        if not sources:
+            sublime.status_message("No TypeScript files to build")
+            return
+        workers = settings.get('maxConcurrentCompiles', 0) or multiprocessing.cpu_count()
+        shards = build_shards(sources, settings, workers)
+        sourcemaps = settings.get('sourceMaps', True)
+        build = {"start": time.time(), "left": len(shards), "results": [None] * len(shards),
+                 "lock": threading.Lock()}
+        print("Building %d files in %d shards" % (len(sources), len(shards)))
+        for i, (out_dir, files) in enumerate(shards):
+            run_async(functools.partial(self.compile_shard, out_dir, files, sourcemaps, settings),
+                      functools.partial(self.on_shard, build, i))
+
+    def compile_shard(self, out_dir, files, sourcemaps, settings):
+        start = time.time()
+        args = list(files)
+        if sourcemaps:
+            args = ['--sourcemap'] + args
+        if out_dir:
+            args = ['--outDir', out_dir] + args
+        try:
+            res = _run(tsc_for(files[0], settings), args, cwd=os.path.dirname(files[0]) if sourcemaps else None,
+                       settings=settings)
+        except Exception as e:
+            # the worker pool drops what work() raises, the build report
+            # would wait for this shard forever
+            traceback.print_exc()
+            res = {"okay": False, "out": "", "err": "tsc failed to run: %s" % e, "diagnostics": []}
+        res["files"] = files
+        res["seconds"] = time.time() - start
+        return res
+
+    def on_shard(self, build, i, res):
+        with build["lock"]:
+            build["results"][i] = res
+            build["left"] -= 1
+            if build["left"]:
+                return
+        elapsed = time.time() - build["start"]
+        sublime.set_timeout(lambda: self.report(build["results"], elapsed), 0)
+
+    def report(self, results, elapsed):
+        diagnostics = [diagnostic for res in results for diagnostic in res["diagnostics"]]
+        update_diagnostics(diagnostics, [source_file for res in results for source_file in res["files"]])
+        errors = sum(1 for diagnostic in diagnostics if diagnostic["category"] == 'error')
+        files = sum(len(res["files"]) for res in results)
+        slowest = max(res["seconds"] for res in results)
+        lines = ["Built %d files in %d shards: %.2fs wall, %.2fs in tsc, slowest shard %.2fs, %d errors" % (
+            files, len(results), elapsed, sum(res["seconds"] for res in results), slowest, errors), ""]
+        for i, res in enumerate(results):
+            lines.append("shard %d: %d files from %s, %.2fs, %d diagnostics" % (
+                i + 1, len(res["files"]), os.path.dirname(res["files"][0]), res["seconds"], len(res["diagnostics"])))
+        lines.append("")
+        lines.extend(format_diagnostic(diagnostic) for diagnostic in diagnostics)
+        # tsc output that did not parse as a diagnostic, like a bad option
+        lines.extend(res["err"] for res in results if not res["okay"] and not res["diagnostics"] and res["err"])
+
+        panel = self.window.get_output_panel('typescript_build')
+        panel.settings().set('result_file_regex', r'^(.+?)\((\d+),(\d+)\): (.*)$')
+        panel.run_command('update_watch', {'pos': 0, 'text': "\n".join(lines)})
+        self.window.run_command('show_panel', {'panel': 'output.typescript_build'})
+        sublime.status_message(lines[0])
+
+
+class PerformanceReportCommand(WindowCommand):
+    """
+    Opens the timings collected with performanceTimings on in a new view,
+    as a table or, with format "json", as JSON to save or compare.
+    """
+
+    def run(self, format="text"):
+        report = timings.report()
+        report["compile cache"] = compile_cache.stats()
+        if format == "json":
+            text = json.dumps(report, indent=2)
+        else:
+            text = self.table(report)
+        view = self.window.new_file()
+        view.set_scratch(True)
+        view.set_name('TypeScript Performance Report')
+        if format == "json":
+            view.set_syntax_file('Packages/JavaScript/JSON.tmLanguage')
+        view.run_command('update_watch', {'pos': 0, 'text': text})
+
+    def table(self, report):
+        lines = []
+        if not report["enabled"]:
+            lines += ['Timings are off, set "performanceTimings": true to collect them.', '']
+        cache = report["compile cache"]
+        lines += ['Compile cache: %d hits, %d misses, %.0f%% hit rate, %d entries, %.1f MB' % (
+            cache["hits"], cache["misses"], 100 * cache["hit_rate"], cache["entries"], cache["bytes"] / 1048576.0), '']
+        sections = [('All files', report["phases"])] + list(report["files"].items())
+        for title, phases in sections:
+            lines += [title, '%-20s %7s %9s %9s %9s %9s %9s' % ('phase (ms)', 'count', 'mean', 'p50', 'p90',
+                                                                'p99', 'max')]
+            for phase, summary in phases.items():
+                lines.append('%-20s %7d %9.2f %9.2f %9.2f %9.2f %9.2f' % (
+                    phase, summary["count"], summary["mean"], summary["p50"], summary["p90"], summary["p99"],
+                    summary["max"]))
+            lines.append('')
+        return "\n".join(lines)
 
 
 class UpdateWatchCommand(sublime_plugin.TextCommand):
+    """
+    Replace the text of the view with text. Only the lines that changed
+    are edited, so the rest keeps its highlighting and the view its scroll
+    position.
+    """
+
+    # changed lines, old and new, past which diffing them costs more than
+    # replacing them all in one edit
+    diff_limit = 4000
+
     def run(self, edit, pos, text):
-        region = sublime.Region(0, self.view.size())
-        self.view.erase(edit, region)
-        self.view.insert(edit, pos, text)
+        old = self.view.substr(sublime.Region(0, self.view.size()))
+        if old == text:
+            return
+        if pos != 0 or not old:
+            self.view.erase(edit, sublime.Region(0, self.view.size()))
+            self.view.insert(edit, pos, text)
+            return
+
+        old_lines = old.splitlines(True)
+        new_lines = text.splitlines(True)
+        # lines at either end that did not change stay out of the diff
+        start = 0
+        limit = min(len(old_lines), len(new_lines))
+        while start < limit and old_lines[start] == new_lines[start]:
+            start += 1
+        end = 0
+        limit -= start
+        while end < limit and old_lines[-1 - end] == new_lines[-1 - end]:
+            end += 1
+        offsets = [sum(len(line) for line in old_lines[:start])]
+        old_lines = old_lines[start:len(old_lines) - end]
+        new_lines = new_lines[start:len(new_lines) - end]
+        for line in old_lines:
+            offsets.append(offsets[-1] + len(line))
+        if len(old_lines) + len(new_lines) > self.diff_limit:
+            self.view.replace(edit, sublime.Region(offsets[0], offsets[-1]), "".join(new_lines))
+            return
+
+        opcodes = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes()
+        # back to front, so the offsets of what is still to come stay valid
+        for tag, i1, i2, j1, j2 in reversed(opcodes):
+            if tag == 'equal':
+                continue
+            if tag == 'insert':
+                self.view.insert(edit, offsets[i1], "".join(new_lines[j1:j2]))
+            elif tag == 'delete':
+                self.view.erase(edit, sublime.Region(offsets[i1], offsets[i2]))
+            else:
+                self.view.replace(edit, sublime.Region(offsets[i1], offsets[i2]), "".join(new_lines[j1:j2]))
 
 watchers = {}
 
+# Decoded source maps shared by all watchers
+source_maps = SourceMapCache(cls=CompactSourceMapDecoder)
+
+
+def configure_source_maps():
+    source_maps.budget = settings_get('sourceMapCacheSize', 64) << 20
+
+
+def load_source_map_text(source):
+    """
+    The decoded index of a source map's text, from source_maps if the same
+    text was seen before.
+    """
+    configure_source_maps()
+    return source_maps.get_source(source)
+
 
 def watched_filename(view):
     if view.file_name() is not None:
@@ -372,8 +2292,20 @@ class Tool():
 
 
 class Watcher():
+    # weight of the latest compile in the moving average of compile times
+    smoothing = 0.3
+
     def __init__(self, inputView):
         self.inputView = inputView
+        # debounce state, see modified()
+        self.compile_time = None
+        self.last_modified = None
+        self.pending_since = None
+        # cursor and scroll sync state, see sync()
+        self.index = None
+        self.moved = {}
+        self.viewports = {}
+        self.scrolled = {}
         print("Now watching " + watched_filename(inputView))
         if self.inputView.window().num_groups() == 1:
             # create new column
@@ -384,50 +2316,183 @@ class Watcher():
             })
         self.create_output()
 
-    def on_done(self, res):
-        if not res["okay"]:
-            sublime.message_dialog("Error. See console.")
+    def on_done(self, res, started):
+        elapsed = time.time() - started
+        if self.compile_time is None:
+            self.compile_time = elapsed
+        else:
+            self.compile_time += self.smoothing * (elapsed - self.compile_time)
+        draw_buffer_diagnostics(self.inputView, res)
+        if not res["js"]:
+            sublime.status_message("Error. See console.")
             print(res["err"])
             return
-        # create new tab
-        self.outputView = self.inputView.window().open_file(self.outputFilePath)
-        # move it to second column
-        self.outputView.window().focus_group(1)
-        self.outputView.window().set_view_index(self.outputView, self.outputView.window().active_group(), 0)
-        # self.outputView.window().focus_group(0)
-        self.inputView.window().focus_view(self.inputView)
-        mapFile = self.sourceFilePath.split(".")[0]+'.js.map'
+        if not res["okay"]:
+            sublime.status_message(first_error(res))
         (inputRow, inputCol) = self.inputView.rowcol(self.inputView.sel()[0].begin())
-        index = load(open(mapFile)).getpos(line=inputRow, column=inputCol)
-        if not index:
+        index = None
+        position = None
+        if res["map"]:
+            with timings.span('source map load', self.sourceFilePath):
+                index = load_source_map_text(res["map"])
+            # also builds the reverse index here, off the main thread, for sync()
+            with timings.span('getpos', self.sourceFilePath):
+                position = index.getpos(line=inputRow, column=inputCol, source=self.sourceFilePath)
+
+        def update():
+            self.index = index
+            with timings.span('view update', self.sourceFilePath):
+                self.outputView.run_command('update_watch', {'pos': 0, 'text': res["js"]})
+                if position:
+                    self.move(self.outputView, position[0], position[1])
+                    self.outputView.show_at_center(self.outputView.sel()[0].begin())
+        sublime.set_timeout(update, 10)
+
+    def to_output(self, row, col):
+        """
+        The (row, col) in the JavaScript of a TypeScript position, or None.
+        """
+        if self.index is None:
+            return None
+        with timings.span('getpos', self.sourceFilePath):
+            return self.index.getpos(row, col, source=self.sourceFilePath)
+
+    def to_input(self, row, col):
+        """
+        The (row, col) in the TypeScript of a JavaScript position, or None.
+        """
+        if self.index is None:
+            return None
+        try:
+            with timings.span('lookup', self.sourceFilePath):
+                token = self.index.lookup(row, col)
+        except (IndexError, KeyError):
+            return None
+        if token.src != self.index.match_source(self.sourceFilePath):
+            return None
+        return token.src_line, token.src_col
+
+    def move(self, view, row, col):
+        point = view.text_point(row, col)
+        # the selection event this causes is not a user's move to sync back
+        self.moved[view.id()] = point
+        selected = view.sel()
+        selected.clear()
+        selected.add(sublime.Region(point, point))
+        view.show(point)
+
+    def sync(self, view):
+        """
+        Move the cursor of the other pane to where view's cursor maps to.
+        """
+        if not current_settings(self.inputView).get('watchSync', True) or not len(view.sel()):
+            return
+        point = view.sel()[0].begin()
+        if self.moved.pop(view.id(), None) == point:
+            return
+        # only the pane being worked in leads, edits from a watch update do not
+        window = view.window()
+        if window is None or window.active_view() is None or window.active_view().id() != view.id():
+            return
+        (row, col) = view.rowcol(point)
+        if view.id() == self.inputView.id():
+            other, position = self.outputView, self.to_output(row, col)
+        else:
+            other, position = self.inputView, self.to_input(row, col)
+        if position:
+            self.move(other, position[0], position[1])
+
+    def poll_viewports(self):
+        """
+        Scroll the other pane along with the one that was scrolled, by
+        mapping the first visible line. Sublime has no scroll event, so
+        viewports are checked every 100ms while watching.
+        """
+        if watchers.get(self.inputView.id()) is not self:
             return
-        (row, col) = index
-        row = int(row)
-        def goto():
-            selected = self.outputView.sel()
-            selected.clear()
-            region_begin = self.outputView.text_point(row, 0)
-            selected.add(sublime.Region(region_begin, region_begin))
-            self.outputView.run_command('move', {'by': 'characters', 'forward': True})
-            self.outputView.run_command('move', {'by': 'characters', 'forward': False})
-            self.outputView.show_at_center(region_begin)
-        sublime.set_timeout(goto, 10)
+        sublime.set_timeout(self.poll_viewports, 100)
+        if not current_settings(self.inputView).get('watchSync', True):
+            return
+        now = time.time()
+        for view, other, to_other in ((self.inputView, self.outputView, self.to_output),
+                                      (self.outputView, self.inputView, self.to_input)):
+            position = view.viewport_position()
+            if position == self.viewports.get(view.id()):
+                continue
+            self.viewports[view.id()] = position
+            # moved by the sync itself a moment ago
+            if now - self.scrolled.get(view.id(), 0) < 0.3:
+                continue
+            (row, col) = view.rowcol(view.visible_region().begin())
+            mapped = to_other(row, 0)
+            if mapped:
+                top = other.text_to_layout(other.text_point(mapped[0], 0))[1]
+                self.scrolled[other.id()] = now
+                other.set_viewport_position((other.viewport_position()[0], top), False)
+            break
 
     def create_output(self):
-        self.sourceFilePath = self.inputView.file_name()
+        self.sourceFilePath = buffer_path(self.inputView)
         self.outputFileName = Tool.get_js_file_name(Tool.get_file_name(self.sourceFilePath))
-        self.outputFilePath = path.join(path.dirname(self.sourceFilePath), self.outputFileName)
-        args = ["--sourcemap", self.sourceFilePath]
-        run("tsc", args, callback=lambda res: self.on_done(res))
+        # the compiled text of the buffer, nothing on disk
+        window = self.inputView.window()
+        self.outputView = window.new_file()
+        self.outputView.set_scratch(True)
+        self.outputView.set_name(self.outputFileName)
+        self.outputView.set_syntax_file('Packages/JavaScript/JavaScript.tmLanguage')
+        # move it to second column
+        window.set_view_index(self.outputView, 1, 0)
+        window.focus_view(self.inputView)
+        self.refresh()
+        sublime.set_timeout(self.poll_viewports, 100)
 
     def refresh(self):
-        args = ["--sourcemap", self.sourceFilePath]
-        run("tsc", args, callback=lambda res: self.on_done(res))
+        started = time.time()
+        compile_text(self.sourceFilePath, Text.all(self.inputView), sourcemap=True,
+                     callback=lambda res: self.on_done(res, started), key=('watch', self.sourceFilePath),
+                     settings=current_settings(self.inputView))
+
+    def delay(self):
+        """
+        Seconds of quiet after an edit before refreshing: twice the moving
+        average compile time of this file, within watchMinDelay and
+        watchMaxDelay milliseconds.
+        """
+        settings = current_settings(self.inputView)
+        low = settings.get('watchMinDelay', 150) / 1000.0
+        high = settings.get('watchMaxDelay', 2000) / 1000.0
+        if self.compile_time is None:
+            return min(max(1.0, low), high)
+        return min(max(2 * self.compile_time, low), high)
+
+    def modified(self):
+        """
+        Refresh once the view has been left alone for delay(), and no later
+        than watchMaxWait milliseconds after the first edit since the last
+        refresh, even while typing goes on.
+        """
+        now = time.time()
+        self.last_modified = now
+        if self.pending_since is None:
+            self.pending_since = now
+            self.wait()
+
+    def wait(self):
+        if watchers.get(self.inputView.id()) is not self:
+            return
+        max_wait = current_settings(self.inputView).get('watchMaxWait', 3000) / 1000.0
+        due = min(self.last_modified + self.delay(), self.pending_since + max_wait)
+        remaining = due - time.time()
+        if remaining > 0.001:
+            sublime.set_timeout(self.wait, int(remaining * 1000) + 1)
+            return
+        self.pending_since = None
+        self.refresh()
 
     def stop(self):
         if not self.inputView.id() in watchers:
             return
-        print("Stop watching: " + self.inputView.file_name())
+        print("Stop watching: " + self.sourceFilePath)
         del watchers[self.inputView.id()]
         window = self.outputView.window() or self.inputView.window()
         if self.outputView.window():
@@ -462,37 +2527,48 @@ class CaptureEditing(sublime_plugin.EventListener):
     def is_enabled(self, view):
         return isTypescript(view)
 
-    def handleTimeout(self, watcher):
-        if self._new_modify and not self._refreshed:
-            sublime.set_timeout(functools.partial(self.handleTimeout, watcher), 1000)
-            self._new_modify = False
-        else:
-            if self._refreshed:
-                return
-            self._refreshed = True
-            watcher.refresh()
-
     def on_modified(self, view):
         if not self.is_enabled(view):
             return
         viewID = view.id()
-        self._new_modify = True
+        if viewID in diagnostic_regions:
+            diagnostic_regions[viewID].modified()
         if viewID in watchers:
-            self._refreshed = False
-            self.handleTimeout(watchers[viewID])
+            watchers[viewID].modified()
+
+    def on_load(self, view):
+        file_name = view.file_name()
+        if file_name and os.path.normcase(file_name) in file_diagnostics:
+            draw_diagnostics(view, file_diagnostics[os.path.normcase(file_name)])
+
+    def on_selection_modified(self, view):
+        viewID = view.id()
+        regions = diagnostic_regions.get(viewID)
+        if regions is not None and regions.keys and len(view.sel()):
+            found = regions.at(view.sel()[0].begin())
+            if found:
+                sublime.status_message('%s %s: %s' % (found[0]["category"], found[0]["code"], found[0]["message"]))
+        if viewID in watchers:
+            watchers[viewID].sync(view)
+            return
+        for watcher in watchers.values():
+            if watcher.outputView.id() == viewID:
+                watcher.sync(view)
+                return
 
     def on_post_save(self, view):
         if not self.is_enabled(view):
             return
-        compile_on_save = settings_get('compileOnSave', True)
+        settings = current_settings(view)
+        compile_on_save = settings.get('compileOnSave', True)
         if compile_on_save is True:
             print("Compiling on save...")
-            view.run_command("compile_code")
+            save_batcher.add(view, settings)
 
-        if settings_get('lintOnSave', True) is True:
+        if settings.get('lintOnSave', True) is True:
             view.run_command("lint_code")
 
-        watch_save = settings_get('watchOnSave', True)
+        watch_save = settings.get('watchOnSave', True)
         if watch_save:
             viewID = view.id()
             if viewID in watchers:
@@ -500,6 +2576,8 @@ class CaptureEditing(sublime_plugin.EventListener):
 
     def on_close(self, view):
         viewID = view.id()
+        settings_snapshots.pop(viewID, None)
+        diagnostic_regions.pop(viewID, None)
         for k, watcher in watchers.items():
             if watcher.outputView.id() == viewID:
                 watcher.stop()
@@ -0,0 +1,84 @@
+"""
+Segments per second of SourceMapDecoder.iter_mappings against the
+split + parse_vlq decoder it replaced, on large synthetic maps.
+
+    python benchmarks/decode_throughput.py
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sourcemap.decoder import SourceMapDecoder
+from sourcemap.exceptions import SourceMapDecodeError
+from synthetic import generate
+
+
+def split_decode(decoder, mappings, sources, names):
+    "The previous decoder loop: split lines and segments, parse_vlq each"
+    dst_col, src_id, src_line, src_col, name_id = 0, 0, 0, 0, 0
+    for dst_line, line in enumerate(mappings.split(';')):
+        dst_col = 0
+        for segment in line.split(','):
+            if not segment:
+                continue
+            parse = decoder.parse_vlq(segment)
+            dst_col += parse[0]
+            src = -1
+            name = -1
+            if len(parse) > 1:
+                try:
+                    src_id += parse[1]
+                    src_line += parse[2]
+                    src_col += parse[3]
+                    src = src_id
+                    if len(parse) > 4:
+                        name_id += parse[4]
+                        name = name_id
+                except IndexError:
+                    raise SourceMapDecodeError
+                if not 0 <= src_id < len(sources) or not name < len(names):
+                    raise SourceMapDecodeError
+            try:
+                assert dst_line >= 0
+                assert dst_col >= 0
+                assert src_line >= 0
+                assert src_col >= 0
+            except AssertionError:
+                raise SourceMapDecodeError
+            yield dst_line, dst_col, src, src_line, src_col, name
+
+
+def best_of(repeat, fn):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+MAPS = [
+    ('many lines', dict(lines=20000, segments_per_line=40)),
+    ('minified, one line', dict(single_line=True, segments_per_line=400000, names=2000, named=0.8)),
+    ('many sources', dict(lines=20000, segments_per_line=40, sources=500)),
+]
+
+
+def main(repeat=3):
+    decoder = SourceMapDecoder()
+    for label, params in MAPS:
+        smap = json.loads(generate(**params))
+        args = (smap['mappings'], smap['sources'], smap['names'])
+        old_time, old = best_of(repeat, lambda: list(split_decode(decoder, *args)))
+        new_time, new = best_of(repeat, lambda: list(decoder.iter_mappings(*args)))
+        assert old == new, label
+        print('%-20s %9d segments  split+parse_vlq %8.0f seg/s  single pass %8.0f seg/s  x%.2f' % (
+            label, len(new), len(new) / old_time, len(new) / new_time, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""
+Benchmark suite for the sourcemap package.
+
+Decodes synthetic maps of every shape and size with each index backend and
+measures decode time, peak memory, lookup and getpos latency, plus
+discover on a generated JavaScript file. Results are written as JSON so
+runs can be compared with --compare.
+
+    python benchmarks/run.py --sizes 1k,100k,1m --output before.json
+    python benchmarks/run.py --sizes 1k,100k,1m --compare before.json
+
+Generated maps are kept in benchmarks/fixtures (see --fixtures), nothing
+is downloaded.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sourcemap
+from sourcemap import SourceMapDecoder, CompactSourceMapDecoder, LazySourceMapDecoder
+from synthetic import SHAPES, SIZES, fixture
+
+BACKENDS = {
+    'tokens': SourceMapDecoder,
+    'compact': CompactSourceMapDecoder,
+    'lazy': LazySourceMapDecoder,
+}
+
+
+def percentiles(samples):
+    "Latency summary in microseconds"
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1e6
+    return {
+        'p50': pick(0.50),
+        'p90': pick(0.90),
+        'p99': pick(0.99),
+        'max': samples[-1] * 1e6,
+    }
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def measure_decode(text, cls, repeat):
+    best = None
+    for _ in range(repeat):
+        elapsed, index = timed(sourcemap.loads, text, cls)
+        best = elapsed if best is None else min(best, elapsed)
+
+    # Peak memory is measured on a separate run, tracemalloc slows decoding down
+    del index
+    tracemalloc.start()
+    index = sourcemap.loads(text, cls)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, index
+
+
+def measure_lookups(index, positions):
+    samples = []
+    for line, column in positions:
+        start = time.perf_counter()
+        try:
+            index.lookup(line, column)
+        except IndexError:
+            pass
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def measure_getpos(index, positions):
+    # The reverse index is built by the first call
+    build, _ = timed(index.getpos, 0, 0, index.sources[0])
+    samples = []
+    for src, line, column in positions:
+        start = time.perf_counter()
+        index.getpos(line, column, src)
+        samples.append(time.perf_counter() - start)
+    return build, percentiles(samples)
+
+
+def measure_discover(lines, repeat):
+    rnd = random.Random(lines)
+    body = ['var v%d = %d;' % (i, rnd.randint(0, 1 << 30)) for i in range(lines)]
+    source = '\n'.join(body + ['//# sourceMappingURL=out.js.map'])
+    best = min(timed(sourcemap.discover, source)[0] for _ in range(repeat))
+    return {'lines': lines, 'bytes': len(source), 'seconds': best}
+
+
+def sample_positions(smap, count, seed):
+    "Random generated and original positions inside the map"
+    rnd = random.Random(seed)
+    lines = smap['mappings'].split(';')
+    generated = []
+    for _ in range(count):
+        line = rnd.randrange(len(lines))
+        # roughly 20 columns per segment in the synthetic maps
+        generated.append((line, rnd.randint(0, 20 * (lines[line].count(',') + 1))))
+    original = [(rnd.choice(smap['sources']), rnd.randint(0, 2000), rnd.randint(0, 120))
+                for _ in range(count)]
+    return generated, original
+
+
+def run(shapes, sizes, backends, fixtures, lookups, repeat):
+    results = []
+    for size in sizes:
+        for shape in shapes:
+            text = fixture(shape, size, fixtures)
+            smap = json.loads(text)
+            generated, original = sample_positions(smap, lookups, seed=len(text))
+            for name in backends:
+                decode, peak, index = measure_decode(text, BACKENDS[name], repeat)
+                result = {
+                    'shape': shape,
+                    'size': size,
+                    'bytes': len(text),
+                    'backend': name,
+                    'decode_s': decode,
+                    'peak_bytes': peak,
+                    'lookup_us': measure_lookups(index, generated),
+                }
+                result['reverse_build_s'], result['getpos_us'] = measure_getpos(index, original)
+                result['segments'] = len(index)
+                results.append(result)
+                sys.stderr.write('%-5s %-13s %-8s decode %8.3fs  peak %7.1f MB  lookup p50 %6.1fus  getpos p50 %6.1fus\n' % (
+                    size, shape, name, decode, peak / float(1 << 20),
+                    result['lookup_us']['p50'], result['getpos_us']['p50']))
+                del index
+    return results
+
+
+def compare(current, previous):
+    "Print the ratio of each metric to the same measurement in a previous run"
+    key = lambda r: (r['shape'], r['size'], r['backend'])
+    before = dict((key(r), r) for r in previous['results'])
+    for result in current['results']:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        sys.stderr.write('%-5s %-13s %-8s decode x%.2f  peak x%.2f  lookup p50 x%.2f  getpos p50 x%.2f\n' % (
+            result['size'], result['shape'], result['backend'],
+            result['decode_s'] / old['decode_s'],
+            result['peak_bytes'] / float(old['peak_bytes']),
+            result['lookup_us']['p50'] / old['lookup_us']['p50'],
+            result['getpos_us']['p50'] / old['getpos_us']['p50']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--shapes', default=','.join(sorted(SHAPES)))
+    parser.add_argument('--sizes', default=','.join(sorted(SIZES, key=SIZES.get)))
+    parser.add_argument('--backends', default=','.join(sorted(BACKENDS)))
+    parser.add_argument('--fixtures', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+    parser.add_argument('--lookups', type=int, default=2000, help='lookups and getpos calls per map')
+    parser.add_argument('--repeat', type=int, default=3, help='decodes per map, the fastest counts')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': run(args.shapes.split(','), args.sizes.split(','), args.backends.split(','),
+                       args.fixtures, args.lookups, args.repeat),
+        'discover': [measure_discover(lines, args.repeat) for lines in (100, 10000, 1000000)],
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
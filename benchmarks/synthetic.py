@@ -0,0 +1,118 @@
+"""
+benchmarks.synthetic
+~~~~~~~~~~~~~~~~~~~~
+
+Deterministic synthetic source maps for the benchmarks.
+"""
+import json
+import os
+import random
+
+B64 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+
+def encode_vlq(value):
+    "Encode one integer as a base64 VLQ string"
+    value = ((-value) << 1) | 1 if value < 0 else value << 1
+    encoded = ''
+    while True:
+        digit = value & 0b11111
+        value >>= 5
+        if value:
+            digit |= 0b100000
+        encoded += B64[digit]
+        if not value:
+            return encoded
+
+
+def generate(lines=1000, segments_per_line=40, sources=4, names=100, named=0.3, seed=0,
+             size=None, single_line=False):
+    """Build the JSON text of a v3 source map.
+
+    Every line gets segments_per_line / 2 to segments_per_line segments.
+    Nine out of ten map back to one of the sources, and of those a named
+    fraction carry a name. With size, lines keep being added until the
+    mappings reach that many characters instead. single_line puts every
+    segment on one line like minified output does. The same arguments
+    always give the same map.
+    """
+    rnd = random.Random(seed)
+    prev_src, prev_line, prev_col, prev_name = 0, 0, 0, 0
+    out = []
+    length = 0
+
+    def full():
+        if size:
+            return length >= size
+        return len(out) >= (1 if single_line else lines)
+
+    while not full():
+        dst_col = 0
+        segments = []
+        count = rnd.randint(segments_per_line // 2, segments_per_line)
+        k = 0
+        while (single_line or k < count) and not (size and length >= size):
+            delta = rnd.randint(1 if k else 0, 40)
+            dst_col += delta
+            segment = encode_vlq(delta)
+            if rnd.random() < 0.9:
+                src = rnd.randrange(sources)
+                src_line = max(0, prev_line + rnd.randint(-3, 6))
+                src_col = rnd.randint(0, 120)
+                segment += encode_vlq(src - prev_src) + encode_vlq(src_line - prev_line) + encode_vlq(src_col - prev_col)
+                prev_src, prev_line, prev_col = src, src_line, src_col
+                if rnd.random() < named:
+                    name = rnd.randrange(names)
+                    segment += encode_vlq(name - prev_name)
+                    prev_name = name
+            segments.append(segment)
+            length += len(segment) + 1
+            k += 1
+            if single_line and not size and k >= count:
+                break
+        out.append(','.join(segments))
+    return json.dumps({
+        'version': 3,
+        'file': 'out.js',
+        'sources': ['src/module%d.ts' % i for i in range(sources)],
+        'names': ['name%d' % i for i in range(names)],
+        'mappings': ';'.join(out),
+    })
+
+
+# Map shapes the suite runs at every size
+SHAPES = {
+    'typical': dict(segments_per_line=40),
+    'many-sources': dict(segments_per_line=40, sources=2000),
+    'long-lines': dict(segments_per_line=4000),
+    'minified': dict(single_line=True, names=5000, named=0.6),
+    'heavy-names': dict(segments_per_line=40, names=50000, named=1.0),
+}
+
+# Approximate size of the mappings string
+SIZES = {
+    '1k': 1 << 10,
+    '100k': 100 << 10,
+    '1m': 1 << 20,
+    '10m': 10 << 20,
+    '50m': 50 << 20,
+}
+
+
+def fixture(shape, size, directory=None):
+    """The JSON text of the map for a shape and size name.
+
+    Large maps take a while to generate, so with a directory they are
+    written there once and read back on later runs.
+    """
+    params = dict(SHAPES[shape], size=SIZES[size])
+    if directory is None:
+        return generate(**params)
+    path = os.path.join(directory, '%s-%s.js.map' % (shape, size))
+    if not os.path.exists(path):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as f:
+            f.write(generate(**params))
+    with open(path) as f:
+        return f.read()
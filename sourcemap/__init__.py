@@ -6,20 +6,34 @@ sourcemap
 :license: BSD, see LICENSE for more details.
 """
 from .exceptions import SourceMapDecodeError  #NOQA
-from .decoder import SourceMapDecoder
+from .decoder import SourceMapDecoder, CompactSourceMapDecoder, LazySourceMapDecoder
+from .cache import SourceMapCache
+from .encoder import SourceMapEncoder
+from .compose import compose
 
 __version__ = '0.1.7'
 
 
-def load(fp, cls=None):
+def load(fp, cls=None, keep_raw=True):
     "Parse a sourcemap from a file-like object"
-    return loads(fp.read(), cls)
+    return loads(fp.read(), cls, keep_raw)
 
 
-def loads(source, cls=None):
+def loads(source, cls=None, keep_raw=True):
     "Parse a sourcemap from a string"
     cls = cls or SourceMapDecoder
-    return cls().decode(source)
+    return cls(keep_raw).decode(source)
+
+
+def load_file(path, cls=None, keep_raw=True):
+    "Parse a sourcemap file through mmap, without reading its sourcesContent"
+    cls = cls or SourceMapDecoder
+    return cls(keep_raw).decode_file(path)
+
+
+def encode(index, file=None):
+    "Serialize a decoded sourcemap index as v3 JSON"
+    return SourceMapEncoder().encode(index, file)
 
 
 def discover(source):
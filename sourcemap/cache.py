@@ -0,0 +1,77 @@
+"""
+sourcemap.cache
+~~~~~~~~~~~~~~~
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from .decoder import SourceMapDecoder
+
+__all__ = ('SourceMapCache',)
+
+
+class SourceMapCache(object):
+    """Decoded source maps by the SHA-1 of their text.
+
+    The same text is decoded once for as long as it stays in the cache.
+    The least recently used entries are dropped once the maps held add up
+    to more than budget bytes; a map is counted at the length of its text,
+    which its decoded index grows with.
+    """
+
+    def __init__(self, budget=64 << 20, cls=None):
+        self.budget = budget
+        self.cls = cls or SourceMapDecoder
+        # text hash -> (size, index), least recently used first
+        self.entries = OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_source(self, source):
+        "The SourceMapIndex of a source map's text, decoding it only if new"
+        digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is not None:
+                self.entries.move_to_end(digest)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        index = self.cls().decode(source)
+        self._insert(digest, (len(source), index))
+        return index
+
+    def _insert(self, key, entry):
+        with self.lock:
+            self._discard(key)
+            if entry[0] <= self.budget:
+                self.entries[key] = entry
+                self.used += entry[0]
+                while self.used > self.budget:
+                    self._discard(next(iter(self.entries)))
+
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.used -= entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+
+    def stats(self):
+        "Hit and miss counters and what the cache holds"
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+                'bytes': self.used,
+                'budget': self.budget,
+            }
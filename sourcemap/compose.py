@@ -0,0 +1,122 @@
+"""
+sourcemap.compose
+~~~~~~~~~~~~~~~~~
+
+Combines the maps of a multi-stage build, like tsc followed by a
+minifier, into one map from the final output to the original sources.
+"""
+from array import array
+from bisect import bisect_right
+from .objects import CompactSourceMapIndex
+
+__all__ = ('compose',)
+
+
+def compose(*indexes):
+    """Compose the maps of a build pipeline into a CompactSourceMapIndex.
+
+    Pass the maps in the order the stages ran: compose(tsc_map,
+    minifier_map) maps the minified output straight back to the .ts
+    sources. Each stage's original positions are looked up in the
+    generated positions of the stage before it, the closest segment at or
+    before the column on the same line, so composing n segments costs
+    O(n log n). Segments that land before the first segment of their line,
+    or on a line the earlier map does not cover, stay in the result
+    without a source. Names come from the earliest stage that has one.
+    """
+    if not indexes:
+        raise ValueError('compose needs at least one source map')
+    composed = columns(indexes[0])
+    for index in indexes[1:]:
+        composed = compose_pair(composed, columns(index))
+    raw, rows, line_offsets, sources, names = composed
+    return CompactSourceMapIndex(raw, rows, line_offsets, sources, names)
+
+
+def columns(index):
+    "The raw map, columns, line offsets, sources and names of any index"
+    if isinstance(index, CompactSourceMapIndex):
+        return (index.raw, (index.dst_line, index.dst_col, index.src_id, index.src_line, index.src_col,
+                index.name_id), index.line_offsets, list(index.sources), list(index.names))
+
+    sources = list(index.sources)
+    names = list(getattr(index, 'names', None) or (index.raw or {}).get('names') or [])
+    source_ids = dict((source, i) for i, source in reversed(list(enumerate(sources))))
+    name_ids = dict((name, i) for i, name in reversed(list(enumerate(names))))
+    rows = tuple(array('i') for _ in range(6))
+    dst_lines, dst_cols, src_ids, src_lines, src_cols, name_ids_column = rows
+    for token in index:
+        dst_lines.append(token.dst_line)
+        dst_cols.append(token.dst_col)
+        src_ids.append(table_id(sources, source_ids, token.src))
+        src_lines.append(token.src_line)
+        src_cols.append(token.src_col)
+        name_ids_column.append(table_id(names, name_ids, token.name))
+
+    if hasattr(index, 'line_starts'):
+        line_count = len(index.line_starts)
+    elif hasattr(index, 'line_index'):
+        line_count = len(index.line_index)
+    else:
+        line_count = index.line_count
+    line_offsets = array('i', [0]) * (line_count + 1)
+    for dst_line in dst_lines:
+        line_offsets[dst_line + 1] += 1
+    for i in range(1, len(line_offsets)):
+        line_offsets[i] += line_offsets[i - 1]
+    return index.raw, rows, line_offsets, sources, names
+
+
+def table_id(table, ids, value):
+    if value is None:
+        return -1
+    if value not in ids:
+        ids[value] = len(table)
+        table.append(value)
+    return ids[value]
+
+
+def compose_pair(first, second):
+    """Compose the columns of two stages, first being the earlier one."""
+    _, first_rows, first_offsets, first_sources, first_names = first
+    dst_col = first_rows[1]
+    first_src_id, first_src_line, first_src_col, first_name_id = first_rows[2:]
+    second_raw, second_rows, line_offsets, second_sources, second_names = second
+    dst_lines, dst_cols, src_ids, src_lines, src_cols, name_ids = second_rows
+
+    # The earliest stage's sources and names, then the names of this stage
+    sources = list(first_sources)
+    names = list(first_names)
+    name_map = dict((name, i) for i, name in reversed(list(enumerate(names))))
+    second_name_ids = [table_id(names, name_map, name) for name in second_names]
+
+    rows = tuple(array('i') for _ in range(6))
+    out_dst_line, out_dst_col, out_src_id, out_src_line, out_src_col, out_name_id = rows
+    line_count = len(first_offsets) - 1
+    # Unmapped segments repeat the last original position, like decoded ones
+    src_line = src_col = 0
+    for i in range(len(dst_lines)):
+        out_dst_line.append(dst_lines[i])
+        out_dst_col.append(dst_cols[i])
+        src_id = name_id = -1
+        line = src_lines[i]
+        if src_ids[i] >= 0 and line < line_count:
+            lo = first_offsets[line]
+            j = bisect_right(dst_col, src_cols[i], lo, first_offsets[line + 1]) - 1
+            if j >= lo and first_src_id[j] >= 0:
+                src_id = first_src_id[j]
+                src_line = first_src_line[j]
+                src_col = first_src_col[j]
+                name_id = first_name_id[j]
+                if name_id < 0 and name_ids[i] >= 0:
+                    name_id = second_name_ids[name_ids[i]]
+        out_src_id.append(src_id)
+        out_src_line.append(src_line)
+        out_src_col.append(src_col)
+        out_name_id.append(name_id)
+
+    raw = dict(second_raw or {})
+    raw.update({'version': 3, 'sources': sources, 'names': names})
+    raw.pop('mappings', None)
+    raw.pop('sourcesContent', None)
+    return raw, rows, line_offsets, sources, names
@@ -12,15 +12,18 @@ Original source under Apache license, see:
 """
 import os
 import sys
+from array import array
 from functools import partial
+from itertools import chain
 from .exceptions import SourceMapDecodeError
-from .objects import Token, SourceMapIndex
+from .objects import Token, SourceMapIndex, CompactSourceMapIndex, LazySourceMapIndex, SectionedSourceMapIndex
+from .stream import load_fields
 try:
     import simplejson as json
 except ImportError:
     import json  #NOQA
 
-__all__ = ('SourceMapDecoder',)
+__all__ = ('SourceMapDecoder', 'CompactSourceMapDecoder', 'LazySourceMapDecoder')
 
 # True if we are running on Python 3.
 PY3 = sys.version_info[0] == 3
@@ -28,6 +31,11 @@ text_type = str if PY3 else unicode
 
 
 class SourceMapDecoder(object):
+    def __init__(self, keep_raw=True):
+        # Without keep_raw indexes get raw=None, and the parsed map,
+        # sourcesContent and all, is let go once decoded
+        self.keep_raw = keep_raw
+
     def parse_vlq(self, segment):
         """
         Parse a string of VLQ-encoded data.
@@ -61,6 +69,44 @@ class SourceMapDecoder(object):
         return values
 
     def decode(self, source):
+        "Decode the text of a source map"
+        return self.decode_json(self.load_json(source))
+
+    def decode_file(self, path):
+        """Decode the source map file at path, reading it through mmap.
+
+        Only the members an index is built from are parsed, so a large
+        sourcesContent is never loaded. raw holds just those members.
+        """
+        return self.decode_json(load_fields(path))
+
+    def decode_json(self, smap):
+        """Decode a parsed source map.
+
+        Index maps, which have sections instead of mappings, become a
+        SectionedSourceMapIndex whose sections are decoded on first use.
+        """
+        if 'sections' in smap:
+            return self.decode_sections(smap)
+        index = self.decode_map(smap)
+        if not self.keep_raw:
+            index.raw = None
+        return index
+
+    def decode_sections(self, smap):
+        offsets, maps = [], []
+        for section in smap['sections']:
+            if 'map' not in section:
+                raise SourceMapDecodeError('index map sections with a url are not supported')
+            if 'sections' in section['map']:
+                raise SourceMapDecodeError('index map sections cannot be index maps')
+            offsets.append((section['offset']['line'], section['offset']['column']))
+            maps.append(section['map'])
+        if offsets != sorted(offsets):
+            raise SourceMapDecodeError('index map sections out of order')
+        return SectionedSourceMapIndex(smap if self.keep_raw else None, offsets, maps, self)
+
+    def decode_map(self, smap):
         """Decode a source map object into a SourceMapIndex.
 
         The index is keyed on (dst_line, dst_column) for lookups,
@@ -101,18 +147,10 @@ class SourceMapDecoder(object):
               - At this point, we know the token location, (1, 12)
               - Pull (1, 12) from index => tokens[3]
         """
-        # According to spec (https://docs.google.com/document/d/1U1RGAehQwRypUTovF1KRlpiOFze0b-_2gc6fAH0KY0k/edit#heading=h.h7yy76c5il9v)
-        # A SouceMap may be prepended with ")]}'" to cause a Javascript error.
-        # If the file starts with that string, ignore the entire first line.
-        if source[:3] == ')]}':
-            source = source.split('\n', 1)[1]
-
-        smap = json.loads(source)
         sources = smap['sources']
         sourceRoot = smap.get('sourceRoot')
         names = list(map(text_type, smap['names']))
         mappings = smap['mappings']
-        lines = mappings.split(';')
 
         # if sourceRoot is not None:
         #     sources = map(partial(os.path.join, sourceRoot), sources)
@@ -121,59 +159,174 @@ class SourceMapDecoder(object):
         tokens = []
 
         # line_index is used to identify the closest column when looking up a token
-        line_index = []
+        line_index = [[] for _ in range(mappings.count(';') + 1)]
 
         # Main index of all tokens
         # The index is keyed on (line, column)
         index = {}
 
-        dst_col, src_id, src_line, src_col, name_id = 0, 0, 0, 0, 0
-        for dst_line, line in enumerate(lines):
-            # Create list for columns in index
-            line_index.append([])
-
-            segments = line.split(',')
-            dst_col = 0
-            for segment in segments:
-                if not segment:
-                    continue
-                parse = self.parse_vlq(segment)
-                dst_col += parse[0]
-
-                src = None
-                name = None
-                if len(parse) > 1:
-                    try:
-                        src_id += parse[1]
-                        src = sources[src_id]
-                        src_line += parse[2]
-                        src_col += parse[3]
-
-                        if len(parse) > 4:
-                            name_id += parse[4]
-                            name = names[name_id]
-                    except IndexError:
-                        raise SourceMapDecodeError
+        for dst_line, dst_col, src_id, src_line, src_col, name_id in self.iter_mappings(mappings, sources, names):
+            src = sources[src_id] if src_id >= 0 else None
+            name = names[name_id] if name_id >= 0 else None
+            token = Token(dst_line, dst_col, src, src_line, src_col, name)
+            tokens.append(token)
 
-                # lol for now
-                try:
-                    assert dst_line >= 0
-                    assert dst_col >= 0
-                    assert src_line >= 0
-                    assert src_col >= 0
-                except AssertionError:
+            # Insert into main index
+            index[(dst_line, dst_col)] = token
+
+            # Insert into specific line index
+            line_index[dst_line].append(dst_col)
+
+        return SourceMapIndex(smap, tokens, line_index, index, sources)
+
+    def load_json(self, source):
+        "Parse the JSON of a source map"
+        # According to spec (https://docs.google.com/document/d/1U1RGAehQwRypUTovF1KRlpiOFze0b-_2gc6fAH0KY0k/edit#heading=h.h7yy76c5il9v)
+        # A SouceMap may be prepended with ")]}'" to cause a Javascript error.
+        # If the file starts with that string, ignore the entire first line.
+        if source[:3] == ')]}':
+            source = source.split('\n', 1)[1]
+        return json.loads(source)
+
+    def iter_mappings(self, mappings, sources, names, first_line=0, state=(0, 0, 0, 0)):
+        """Decode a mappings string into absolute segment values.
+
+        Yields (dst_line, dst_col, src_id, src_line, src_col, name_id) per
+        segment, with src_id and name_id set to -1 when the segment has no
+        source or no name.
+
+        Decoding can start part way into a map: first_line is the generated
+        line mappings starts at and state the (src_id, src_line, src_col,
+        name_id) values carried over from the lines before it.
+
+        The string is walked once, character by character, without
+        splitting it into lines and segments first. VLQ_CHARS tells what
+        each character is and VLQ_SINGLE holds the final value of the
+        common one character VLQ numbers.
+        """
+        chars, single = VLQ_CHARS, VLQ_SINGLE
+        source_count, name_count = len(sources), len(names)
+        src_id, src_line, src_col, name_id = state
+        dst_line, dst_col = first_line, 0
+
+        # Values of the segment being read and of its unfinished VLQ number
+        fields = []
+        field = fields.append
+        cur, shift = 0, 0
+
+        # The trailing LINE_END flushes the last segment
+        for c in chain(mappings, ';'):
+            try:
+                val = chars[c]
+            except KeyError:
+                raise SourceMapDecodeError('invalid character %r in mappings' % c)
+
+            if val < 32:
+                # Last character of a number, the low bit of which is the sign
+                if shift:
+                    cur += val << shift
+                    field(-(cur >> 1) if cur & 1 else cur >> 1)
+                    cur, shift = 0, 0
+                else:
+                    field(single[val])
+                continue
+            if val < 64:
+                # 5 value bits followed by more
+                cur += (val & 0b11111) << shift
+                shift += 5
+                continue
+
+            # SEGMENT_END or LINE_END
+            if shift:
+                raise SourceMapDecodeError('leftover cur/shift in vlq decode')
+            if fields:
+                count = len(fields)
+                dst_col += fields[0]
+                src = -1
+                name = -1
+                if count > 1:
+                    if count < 4:
+                        raise SourceMapDecodeError
+                    src_id += fields[1]
+                    src_line += fields[2]
+                    src_col += fields[3]
+                    src = src_id
+                    if count > 4:
+                        name_id += fields[4]
+                        name = name_id
+                    if not 0 <= src_id < source_count or not name < name_count:
+                        raise SourceMapDecodeError
+                if dst_col < 0 or src_line < 0 or src_col < 0:
                     raise SourceMapDecodeError
 
-                token = Token(dst_line, dst_col, src, src_line, src_col, name)
-                tokens.append(token)
+                yield dst_line, dst_col, src, src_line, src_col, name
+                del fields[:]
+            if val == LINE_END:
+                dst_line += 1
+                dst_col = 0
 
-                # Insert into main index
-                index[(dst_line, dst_col)] = token
 
-                # Insert into specific line index
-                line_index[dst_line].append(dst_col)
+class CompactSourceMapDecoder(SourceMapDecoder):
+    """Decodes into a CompactSourceMapIndex.
 
-        return SourceMapIndex(smap, tokens, line_index, index, sources)
+    Pass it as cls to load/loads for large maps, where one Token object per
+    segment costs too much memory. The sections of index maps are decoded
+    into CompactSourceMapIndex too.
+    """
+    def decode_map(self, smap):
+        """Decode a source map object into a CompactSourceMapIndex.
+
+        Every segment becomes one row in six parallel array('i') columns.
+        Rows are in generated order, so the rows of generated line n are
+        line_offsets[n]:line_offsets[n + 1].
+        """
+        sources = smap['sources']
+        names = list(map(text_type, smap['names']))
+        mappings = smap['mappings']
+
+        columns = tuple(array('i') for _ in range(6))
+        dst_lines, dst_cols, src_ids, src_lines, src_cols, name_ids = columns
+        line_offsets = array('i', [0]) * (mappings.count(';') + 2)
+
+        for dst_line, dst_col, src_id, src_line, src_col, name_id in self.iter_mappings(mappings, sources, names):
+            dst_lines.append(dst_line)
+            dst_cols.append(dst_col)
+            src_ids.append(src_id)
+            src_lines.append(src_line)
+            src_cols.append(src_col)
+            name_ids.append(name_id)
+            line_offsets[dst_line + 1] += 1
+
+        for i in range(1, len(line_offsets)):
+            line_offsets[i] += line_offsets[i - 1]
+
+        return CompactSourceMapIndex(smap, columns, line_offsets, sources, names)
+
+
+class LazySourceMapDecoder(SourceMapDecoder):
+    """Decodes into a LazySourceMapIndex.
+
+    Pass it as cls to load/loads when only a few lines of a large map are
+    going to be looked up.
+    """
+    def decode_map(self, smap):
+        """Prepare a source map object for decoding on demand.
+
+        The only pass over mappings records where each generated line
+        starts, everything else is left to LazySourceMapIndex.
+        """
+        sources = smap['sources']
+        names = list(map(text_type, smap['names']))
+        mappings = smap['mappings']
+
+        line_starts = array('i', [0])
+        find = mappings.find
+        i = find(';')
+        while i != -1:
+            line_starts.append(i + 1)
+            i = find(';', i + 1)
+
+        return LazySourceMapIndex(smap, mappings, line_starts, self, sources, names)
 
 
 # Mapping of base64 letter -> integer value.
@@ -181,3 +334,15 @@ class SourceMapDecoder(object):
 B64 = [-1] * 123
 for i, c in enumerate('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'):
     B64[ord(c)] = i
+
+# Mapping of mappings character -> what it means to the decoder.
+# 0-31: the 5 value bits of the last character of a VLQ number
+# 32-63: the same, with the continuation bit set
+SEGMENT_END = 64
+LINE_END = 65
+VLQ_CHARS = {',': SEGMENT_END, ';': LINE_END}
+for i, c in enumerate('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'):
+    VLQ_CHARS[c] = i
+
+# Value of a VLQ number made of a single character, sign applied
+VLQ_SINGLE = [-(i >> 1) if i & 1 else i >> 1 for i in range(32)]
@@ -0,0 +1,95 @@
+"""
+sourcemap.encoder
+~~~~~~~~~~~~~~~~~
+
+Writes source map indexes back out as v3 source maps.
+"""
+import json
+from .compose import columns
+
+__all__ = ('SourceMapEncoder', 'encode_vlq')
+
+B64 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+# The one character encodings of -15..15, which most deltas are
+VLQ_SINGLE = dict((value, B64[((-value) << 1) | 1 if value < 0 else value << 1]) for value in range(-15, 16))
+
+
+def encode_vlq(value):
+    "Encode one integer as a base64 VLQ string"
+    try:
+        return VLQ_SINGLE[value]
+    except KeyError:
+        pass
+    value = ((-value) << 1) | 1 if value < 0 else value << 1
+    encoded = ''
+    while True:
+        digit = value & 0b11111
+        value >>= 5
+        if value:
+            digit |= 0b100000
+        encoded += B64[digit]
+        if not value:
+            return encoded
+
+
+class SourceMapEncoder(object):
+    def encode(self, index, file=None):
+        """Encode a source map index as the JSON text of a v3 source map.
+
+        Any of the index types works, loads() of the result decodes to the
+        same segments.
+        """
+        return json.dumps(self.encode_map(index, file))
+
+    def encode_map(self, index, file=None):
+        "The v3 source map of index as a dict"
+        sources, names, rows, line_count = self.rows(index)
+        smap = {
+            'version': 3,
+            'sources': sources,
+            'names': names,
+            'mappings': self.encode_mappings(rows, line_count),
+        }
+        if file is None and index.raw:
+            file = index.raw.get('file')
+        if file is not None:
+            smap['file'] = file
+        return smap
+
+    def rows(self, index):
+        """The sources, names, (dst_line, dst_col, src_id, src_line,
+        src_col, name_id) rows in generated order and generated line count
+        of index."""
+        _, rows, line_offsets, sources, names = columns(index)
+        return sources, names, zip(*rows), len(line_offsets) - 1
+
+    def encode_mappings(self, rows, line_count=0):
+        """Encode (dst_line, dst_col, src_id, src_line, src_col, name_id)
+        rows, sorted in generated order, into a mappings string of at least
+        line_count lines."""
+        vlq = encode_vlq
+        lines = []
+        segments = []
+        line = 0
+        dst_col = src_id = src_line = src_col = name_id = 0
+        for row_line, row_col, row_src, row_src_line, row_src_col, row_name in rows:
+            if row_line != line:
+                lines.append(','.join(segments))
+                # Lines without segments in between
+                lines.extend([''] * (row_line - line - 1))
+                segments = []
+                line = row_line
+                dst_col = 0
+            segment = vlq(row_col - dst_col)
+            dst_col = row_col
+            if row_src >= 0:
+                segment += vlq(row_src - src_id) + vlq(row_src_line - src_line) + vlq(row_src_col - src_col)
+                src_id, src_line, src_col = row_src, row_src_line, row_src_col
+                if row_name >= 0:
+                    segment += vlq(row_name - name_id)
+                    name_id = row_name
+            segments.append(segment)
+        lines.append(','.join(segments))
+        lines.extend([''] * (line_count - len(lines)))
+        return ';'.join(lines)
@@ -5,6 +5,8 @@ sourcemap.objects
 :copyright: (c) 2013 by Matt Robenolt
 :license: BSD, see LICENSE for more details.
 """
+import threading
+from array import array
 from bisect import bisect_right
 
 
@@ -55,6 +57,12 @@ class SourceMapIndex(object):
         self.line_index = line_index
         self.index = index
         self.sources = sources or []
+        self._init_reverse()
+
+    def _init_reverse(self):
+        "Reset what getpos builds on first use"
+        self.reverse_index = None
+        self.source_matches = None
 
     def lookup(self, line, column):
         try:
@@ -78,15 +86,82 @@ class SourceMapIndex(object):
         # Return from the main index, based on the (line, column) tuple
         return self.index[(line, column)]
 
-    def getpos(self,line,column):
-        for l in range(len(self.line_index)):
-            for c in self.line_index[l]:
-                if self.lookup(l,c).src_line ==line:
-                    return l,c
+    def getpos(self, line, column, source=None):
+        """Find the generated (line, column) for a position in an original source.
+
+        Answers from the reverse index, which is built on first use. The
+        result is the generated position of the closest mapped source position
+        at or before (line, column) on that line, otherwise of the next mapped
+        position after it. Returns None if nothing maps there.
+
+        source picks which original file (line, column) refers to. It is
+        matched against the map's sources, also by path suffix, so the path
+        of the source file can be passed as is. Without it every source is
+        searched and the earliest generated position wins.
+        """
+        if self.reverse_index is None:
+            self.reverse_index = self.build_reverse_index()
+
+        if source is None:
+            candidates = [src for src in self.reverse_index if src is not None]
+        else:
+            src = source if source in self.reverse_index else self.match_source(source)
+            candidates = [src] if src in self.reverse_index else []
+
+        found = None
+        for src in candidates:
+            pos = self._reverse_lookup(self.reverse_index[src], line, column)
+            if pos is not None and (found is None or pos < found):
+                found = pos
+        return found
+
+    def _reverse_lookup(self, entry, line, column):
+        keys, positions = entry
+        i = bisect_right(keys, (line, column))
+        if i and keys[i - 1][0] == line:
+            return positions[i - 1]
+        if i < len(keys):
+            return positions[i]
+        return None
 
-            # for j in range(column):
-                # if self.lookup
-                # if self.lookup()
+    def build_reverse_index(self):
+        """Index the tokens on (src, src_line, src_col).
+
+        Returns a dict of src -> (keys, positions), two parallel lists sorted
+        by source position where keys holds (src_line, src_col) and positions
+        the (dst_line, dst_col) it was generated at. A source position that
+        was generated more than once keeps its first generated position.
+        """
+        return dict((src, reverse_entry(rows)) for src, rows in self.reverse_rows().items())
+
+    def reverse_rows(self):
+        """Group (src_line, src_col, dst_line, dst_col) rows by src."""
+        rows = {}
+        for token in self:
+            if token.src is None:
+                continue
+            rows.setdefault(token.src, []).append(
+                (token.src_line, token.src_col, token.dst_line, token.dst_col))
+        return rows
+
+    def match_source(self, source):
+        """Find the entry of sources that source refers to, or None."""
+        if self.source_matches is None:
+            # Every source matches itself
+            self.source_matches = dict((src, src) for src in self.sources)
+        if source not in self.source_matches:
+            self.source_matches[source] = self._match_source(source)
+        return self.source_matches[source]
+
+    def _match_source(self, source):
+        wanted = source.replace('\\', '/')
+        for src in self.sources:
+            tail = src.replace('\\', '/')
+            while tail.startswith('./') or tail.startswith('../'):
+                tail = tail.split('/', 1)[1]
+            if wanted == tail or wanted.endswith('/' + tail):
+                return src
+        return None
 
     def __getitem__(self, item):
         return self.tokens[item]
@@ -99,3 +174,307 @@ class SourceMapIndex(object):
 
     def __repr__(self):
         return '<SourceMapIndex: %s>' % ', '.join(map(str, self.sources))
+
+
+class CompactSourceMapIndex(SourceMapIndex):
+    """A SourceMapIndex storing its tokens in parallel integer columns.
+
+    Each segment is one row across dst_line, dst_col, src_id, src_line,
+    src_col and name_id, with -1 for a missing source or name. The rows of
+    generated line n are line_offsets[n]:line_offsets[n + 1]. Token objects
+    are only created when one is asked for.
+    """
+
+    def __init__(self, raw, columns, line_offsets, sources=None, names=None):
+        self.raw = raw
+        (self.dst_line, self.dst_col, self.src_id,
+         self.src_line, self.src_col, self.name_id) = columns
+        self.line_offsets = line_offsets
+        self.sources = sources or []
+        self.names = names or []
+        self._init_reverse()
+
+    def token(self, i):
+        "Build the Token for row i"
+        src_id = self.src_id[i]
+        name_id = self.name_id[i]
+        return Token(self.dst_line[i], self.dst_col[i],
+                     self.sources[src_id] if src_id >= 0 else None,
+                     self.src_line[i], self.src_col[i],
+                     self.names[name_id] if name_id >= 0 else None)
+
+    def lookup(self, line, column):
+        lo = self.line_offsets[line]
+        hi = self.line_offsets[line + 1]
+        # Find the closest column token within this line's rows
+        i = bisect_right(self.dst_col, column, lo, hi)
+        if i == lo:
+            # Same fallback as SourceMapIndex.lookup, which indexes the
+            # line's columns with len - 3, wrapping around when negative
+            count = hi - lo
+            i = count - 3
+            if i < 0:
+                i += count
+            if not 0 <= i < count:
+                raise IndexError(line)
+            return self.token(lo + i)
+        return self.token(i - 1)
+
+    def reverse_rows(self):
+        rows = {}
+        dst_line, dst_col = self.dst_line, self.dst_col
+        src_line, src_col = self.src_line, self.src_col
+        for i, src_id in enumerate(self.src_id):
+            if src_id < 0:
+                continue
+            rows.setdefault(self.sources[src_id], []).append(
+                (src_line[i], src_col[i], dst_line[i], dst_col[i]))
+        return rows
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self.token(i) for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError(item)
+        return self.token(item)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.token(i)
+
+    def __len__(self):
+        return len(self.dst_col)
+
+
+class LazySourceMapIndex(SourceMapIndex):
+    """A SourceMapIndex decoding generated lines as they are looked up.
+
+    Decoded lines are cached. Because VLQ values are relative to the
+    previous segment, decoding line n needs the source, line, column and
+    name values in effect where it starts. Those are kept per line in
+    checkpoints, filled in up to the furthest line decoded so far, so a
+    line is never scanned twice to reach a later one.
+    """
+
+    def __init__(self, raw, mappings, line_starts, decoder, sources=None, names=None):
+        self.raw = raw
+        self.mappings = mappings
+        self.line_starts = line_starts
+        self.decoder = decoder
+        self.sources = sources or []
+        self.names = names or []
+        # (src_id, src_line, src_col, name_id) at the start of each line
+        self.checkpoints = tuple(array('i', [0]) for _ in range(4))
+        # line -> (columns, tokens)
+        self.lines = {}
+        self._init_reverse()
+
+    def _rows(self, line):
+        "Decode the segments of one line, and the state following it"
+        start = self.line_starts[line]
+        if line + 1 < len(self.line_starts):
+            end = self.line_starts[line + 1] - 1
+        else:
+            end = len(self.mappings)
+        state = [checkpoint[line] for checkpoint in self.checkpoints]
+        rows = list(self.decoder.iter_mappings(
+            self.mappings[start:end], self.sources, self.names, line, state))
+        for row in rows:
+            if row[2] >= 0:
+                state[0:3] = row[2:5]
+            if row[5] >= 0:
+                state[3] = row[5]
+        return rows, state
+
+    def _advance(self, line, state):
+        "Record the state after line if it is the next one missing"
+        if len(self.checkpoints[0]) == line + 1:
+            for checkpoint, value in zip(self.checkpoints, state):
+                checkpoint.append(value)
+
+    def line(self, line):
+        "The (columns, tokens) of generated line, decoded on first use"
+        if line < 0:
+            line += len(self.line_starts)
+        try:
+            return self.lines[line]
+        except KeyError:
+            pass
+        if not 0 <= line < len(self.line_starts):
+            raise IndexError(line)
+
+        # Catch the checkpoints up, without keeping the lines in between
+        for previous in range(len(self.checkpoints[0]) - 1, line):
+            self._advance(previous, self._rows(previous)[1])
+
+        rows, state = self._rows(line)
+        self._advance(line, state)
+        sources, names = self.sources, self.names
+        tokens = [Token(dst_line, dst_col, sources[src_id] if src_id >= 0 else None,
+                        src_line, src_col, names[name_id] if name_id >= 0 else None)
+                  for dst_line, dst_col, src_id, src_line, src_col, name_id in rows]
+        self.lines[line] = ([token.dst_col for token in tokens], tokens)
+        return self.lines[line]
+
+    def lookup(self, line, column):
+        line_index, tokens = self.line(line)
+        # Find the closest column token
+        i = bisect_right(line_index, column)
+        if not i:
+            # Same fallback as SourceMapIndex.lookup
+            i = len(line_index)-2
+        return tokens[i - 1]
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return list(self)[item]
+        if item < 0:
+            item += len(self)
+        if item >= 0:
+            for line in range(len(self.line_starts)):
+                tokens = self.line(line)[1]
+                if item < len(tokens):
+                    return tokens[item]
+                item -= len(tokens)
+        raise IndexError(item)
+
+    def __iter__(self):
+        for line in range(len(self.line_starts)):
+            for token in self.line(line)[1]:
+                yield token
+
+    def __len__(self):
+        return sum(len(self.line(line)[1]) for line in range(len(self.line_starts)))
+
+
+class SectionedSourceMapIndex(SourceMapIndex):
+    """A SourceMapIndex over the sections of an index map.
+
+    Each section is a source map of its own for the generated code from
+    its (line, column) offset up to the next section's. A section is
+    decoded by decoder the first time a lookup falls inside it, or getpos
+    asks for one of its sources. Tokens come out with their positions in
+    the whole generated file.
+    """
+
+    def __init__(self, raw, offsets, maps, decoder):
+        self.raw = raw
+        self.offsets = offsets
+        # Parsed maps of the sections not decoded yet
+        self.maps = maps
+        self.indexes = [None] * len(maps)
+        self.decoder = decoder
+        self.lock = threading.Lock()
+        self.sources = []
+        self.names = []
+        # src -> the sections using it
+        self.source_sections = {}
+        seen_names = set()
+        for i, smap in enumerate(maps):
+            for src in smap['sources']:
+                sections = self.source_sections.setdefault(src, [])
+                if not sections:
+                    self.sources.append(src)
+                if sections[-1:] != [i]:
+                    sections.append(i)
+            for name in smap['names']:
+                if name not in seen_names:
+                    seen_names.add(name)
+                    self.names.append(name)
+        self.line_count = offsets[-1][0] + maps[-1]['mappings'].count(';') + 1 if maps else 0
+        self._init_reverse()
+        # Built one source at a time by getpos
+        self.reverse_index = SectionReverseIndex(self)
+
+    def section(self, i):
+        "The index of section i, decoded on first use"
+        with self.lock:
+            if self.indexes[i] is None:
+                self.indexes[i] = self.decoder.decode_json(self.maps[i])
+                self.maps[i] = None
+            return self.indexes[i]
+
+    def shift(self, token, i):
+        "token of section i, moved to its position in the generated file"
+        line, column = self.offsets[i]
+        if token.dst_line:
+            column = 0
+        return Token(token.dst_line + line, token.dst_col + column,
+                     token.src, token.src_line, token.src_col, token.name)
+
+    def lookup(self, line, column):
+        i = bisect_right(self.offsets, (line, column)) - 1
+        if i < 0:
+            raise IndexError(line)
+        offset_line, offset_col = self.offsets[i]
+        if line == offset_line:
+            column -= offset_col
+        return self.shift(self.section(i).lookup(line - offset_line, column), i)
+
+    def source_rows(self, src):
+        "The reverse rows of src, from the sections that use it"
+        rows = []
+        for i in self.source_sections.get(src, ()):
+            for token in self.section(i):
+                if token.src == src:
+                    token = self.shift(token, i)
+                    rows.append((token.src_line, token.src_col, token.dst_line, token.dst_col))
+        return rows
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return list(self)[item]
+        if item < 0:
+            item += len(self)
+        if item >= 0:
+            for i in range(len(self.offsets)):
+                section = self.section(i)
+                if item < len(section):
+                    return self.shift(section[item], i)
+                item -= len(section)
+        raise IndexError(item)
+
+    def __iter__(self):
+        for i in range(len(self.offsets)):
+            for token in self.section(i):
+                yield self.shift(token, i)
+
+    def __len__(self):
+        return sum(len(self.section(i)) for i in range(len(self.offsets)))
+
+
+class SectionReverseIndex(dict):
+    """The reverse index of a SectionedSourceMapIndex, filled in per source.
+
+    Looks like a complete one to SourceMapIndex.getpos, but a source's
+    entry is only built, decoding the sections that use it, when asked for.
+    """
+
+    def __init__(self, index):
+        dict.__init__(self)
+        self.index = index
+
+    def __contains__(self, src):
+        return src in self.index.source_sections
+
+    def __iter__(self):
+        return iter(self.index.sources)
+
+    def __missing__(self, src):
+        entry = self[src] = reverse_entry(self.index.source_rows(src))
+        return entry
+
+
+def reverse_entry(rows):
+    """The (keys, positions) reverse index entry of one source's
+    (src_line, src_col, dst_line, dst_col) rows."""
+    rows.sort()
+    keys, positions = [], []
+    for src_line, src_col, dst_line, dst_col in rows:
+        if keys and keys[-1] == (src_line, src_col):
+            continue
+        keys.append((src_line, src_col))
+        positions.append((dst_line, dst_col))
+    return keys, positions
@@ -0,0 +1,160 @@
+"""
+sourcemap.stream
+~~~~~~~~~~~~~~~~
+
+Reads the JSON of a source map file in place through mmap. Only the
+members an index is built from are decoded, everything else, like a
+sourcesContent of hundreds of megabytes, is stepped over without being
+copied out of the mapping.
+"""
+import json
+import mmap
+import os
+import re
+from .exceptions import SourceMapDecodeError
+
+__all__ = ('load_fields',)
+
+# Members decoded at any depth, the rest are skipped
+FIELDS = frozenset(['version', 'file', 'sourceRoot', 'sources', 'names', 'mappings',
+                    'sections', 'offset', 'line', 'column', 'map', 'url'])
+
+SPACE = re.compile(br'[ \t\n\r]*')
+SCALAR = re.compile(br'-?[0-9][0-9.eE+-]*|true|false|null')
+# What skipping a container needs to see, strings may contain brackets
+TOKEN = re.compile(br'["\[\]{}]')
+QUOTE = ord('"')
+BACKSLASH = ord('\\')
+OPEN = frozenset(b'[{')
+
+
+def load_fields(path, fields=FIELDS):
+    """Decode the source map file at path, skipping members not in fields.
+
+    The file is mapped rather than read, so a skipped member costs a scan
+    of its bytes and no memory.
+    """
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            raise SourceMapDecodeError('empty source map: %s' % path)
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        pos = space(buf, 0)
+        # Same as SourceMapDecoder.load_json, a ")]}'" line is ignored
+        if buf[pos:pos + 3] == b')]}':
+            pos = space(buf, buf.find(b'\n', pos) + 1 or len(buf))
+        if buf[pos:pos + 1] != b'{':
+            raise SourceMapDecodeError('a source map is a JSON object: %s' % path)
+        smap, pos = read_object(buf, pos, fields)
+        if space(buf, pos) != len(buf):
+            raise SourceMapDecodeError('extra data after the source map at byte %d' % pos)
+        return smap
+    finally:
+        buf.close()
+
+
+def space(buf, pos):
+    return SPACE.match(buf, pos).end()
+
+
+def read_value(buf, pos, fields):
+    "Decode the value at pos, returning it and the position after it"
+    c = buf[pos:pos + 1]
+    if c == b'{':
+        return read_object(buf, pos, fields)
+    if c == b'[' and buf[space(buf, pos + 1):space(buf, pos + 1) + 1] == b'{':
+        # Arrays of objects, like sections, may hold members to skip
+        return read_array(buf, pos, fields)
+    end = skip_value(buf, pos)
+    try:
+        return json.loads(buf[pos:end].decode('utf-8')), end
+    except ValueError as e:
+        raise SourceMapDecodeError('invalid JSON at byte %d: %s' % (pos, e))
+
+
+def read_object(buf, pos, fields):
+    obj = {}
+    pos = space(buf, pos + 1)
+    if buf[pos:pos + 1] == b'}':
+        return obj, pos + 1
+    while True:
+        if buf[pos:pos + 1] != b'"':
+            raise SourceMapDecodeError('expected a member name at byte %d' % pos)
+        end = string_end(buf, pos)
+        key = json.loads(buf[pos:end].decode('utf-8'))
+        pos = space(buf, end)
+        if buf[pos:pos + 1] != b':':
+            raise SourceMapDecodeError('expected ":" at byte %d' % pos)
+        pos = space(buf, pos + 1)
+        if key in fields:
+            obj[key], pos = read_value(buf, pos, fields)
+        else:
+            pos = skip_value(buf, pos)
+        pos = space(buf, pos)
+        c = buf[pos:pos + 1]
+        if c == b'}':
+            return obj, pos + 1
+        if c != b',':
+            raise SourceMapDecodeError('expected "," or "}" at byte %d' % pos)
+        pos = space(buf, pos + 1)
+
+
+def read_array(buf, pos, fields):
+    items = []
+    pos = space(buf, pos + 1)
+    while True:
+        item, pos = read_value(buf, pos, fields)
+        items.append(item)
+        pos = space(buf, pos)
+        c = buf[pos:pos + 1]
+        if c == b']':
+            return items, pos + 1
+        if c != b',':
+            raise SourceMapDecodeError('expected "," or "]" at byte %d' % pos)
+        pos = space(buf, pos + 1)
+
+
+def string_end(buf, pos):
+    """The position after the string starting at pos.
+
+    Jumps from quote to quote with find, a quote preceded by an odd number
+    of backslashes is escaped.
+    """
+    find = buf.find
+    end = pos
+    while True:
+        end = find(b'"', end + 1)
+        if end == -1:
+            raise SourceMapDecodeError('unterminated string at byte %d' % pos)
+        escape = end - 1
+        while buf[escape] == BACKSLASH:
+            escape -= 1
+        if (end - escape) & 1:
+            return end + 1
+
+
+def skip_value(buf, pos):
+    "The position after the value at pos, found without decoding it"
+    c = buf[pos:pos + 1]
+    if c == b'"':
+        return string_end(buf, pos)
+    if c != b'[' and c != b'{':
+        match = SCALAR.match(buf, pos)
+        if match is None:
+            raise SourceMapDecodeError('invalid JSON at byte %d' % pos)
+        return match.end()
+
+    depth = 0
+    end = pos
+    while True:
+        match = TOKEN.search(buf, end)
+        if match is None:
+            raise SourceMapDecodeError('unterminated JSON value at byte %d' % pos)
+        c = buf[match.start()]
+        if c == QUOTE:
+            end = string_end(buf, match.start())
+            continue
+        end = match.end()
+        depth += 1 if c in OPEN else -1
+        if not depth:
+            return end
@@ -0,0 +1,39 @@
+import json
+import unittest
+from .. import SourceMapCache, CompactSourceMapDecoder
+
+
+def source_map(source):
+    return json.dumps({'version': 3, 'sources': [source], 'names': [], 'mappings': 'AAAA'})
+
+
+class SourceMapCacheTestCase(unittest.TestCase):
+    def test_get_source(self):
+        cache = SourceMapCache(cls=CompactSourceMapDecoder)
+        index = cache.get_source(source_map('a.ts'))
+        self.assertIs(cache.get_source(source_map('a.ts')), index)
+        self.assertIsNot(cache.get_source(source_map('b.ts')), index)
+        self.assertEqual(list(index.sources), ['a.ts'])
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 2, 2))
+        self.assertEqual(stats['bytes'], 2 * len(source_map('a.ts')))
+
+    def test_budget(self):
+        size = len(source_map('a.ts'))
+        cache = SourceMapCache(budget=2 * size)
+        first = cache.get_source(source_map('a.ts'))
+        cache.get_source(source_map('b.ts'))
+        # a.ts is used last, so b.ts goes
+        cache.get_source(source_map('a.ts'))
+        cache.get_source(source_map('c.ts'))
+        self.assertIs(cache.get_source(source_map('a.ts')), first)
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertEqual(cache.stats()['misses'], 3)
+
+        cache.clear()
+        self.assertEqual((cache.stats()['entries'], cache.stats()['bytes']), (0, 0))
+
+    def test_over_budget(self):
+        cache = SourceMapCache(budget=10)
+        cache.get_source(source_map('a.ts'))
+        self.assertEqual(cache.stats()['entries'], 0)
@@ -0,0 +1,42 @@
+import unittest
+from .. import loads, compose, SourceMapDecoder, CompactSourceMapDecoder, LazySourceMapDecoder
+
+# a.ts -> a.js, "foo" at a.js 0:4
+TSC_MAP = '{"version":3,"file":"a.js","sources":["a.ts"],"names":["foo"],"mappings":"AAAA,IAAIA;AAEJ"}'
+# a.js -> a.min.js, the last segment maps nowhere
+MINIFIER_MAP = '{"version":3,"file":"a.min.js","sources":["a.js"],"names":["bar"],"mappings":"AAAA,GAAK,IACHA,E"}'
+
+DECODERS = (SourceMapDecoder, CompactSourceMapDecoder, LazySourceMapDecoder)
+
+
+def rows(index):
+    return [(t.dst_line, t.dst_col, t.src, t.src_line, t.src_col, t.name) for t in index]
+
+
+class ComposeTestCase(unittest.TestCase):
+    def test_compose_two_stages(self):
+        expected = [
+            (0, 0, 'a.ts', 0, 0, None),
+            # the name of the earliest stage wins
+            (0, 3, 'a.ts', 0, 4, 'foo'),
+            # and the later stage's name fills in where it has none
+            (0, 7, 'a.ts', 2, 0, 'bar'),
+            (0, 9, None, 2, 0, None),
+        ]
+        for first in DECODERS:
+            for second in DECODERS:
+                composed = compose(loads(TSC_MAP, first), loads(MINIFIER_MAP, second))
+                self.assertEqual(rows(composed), expected)
+                self.assertEqual(list(composed.sources), ['a.ts'])
+                self.assertEqual(composed.raw['file'], 'a.min.js')
+
+    def test_lookup(self):
+        composed = compose(loads(TSC_MAP), loads(MINIFIER_MAP))
+        token = composed.lookup(0, 5)
+        self.assertEqual((token.src, token.src_line, token.src_col, token.name), ('a.ts', 0, 4, 'foo'))
+
+    def test_single_map(self):
+        self.assertEqual(rows(compose(loads(TSC_MAP))), rows(loads(TSC_MAP)))
+
+    def test_no_maps(self):
+        self.assertRaises(ValueError, compose)
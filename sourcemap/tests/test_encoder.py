@@ -0,0 +1,44 @@
+import json
+import unittest
+from .. import loads, encode, SourceMapDecoder, CompactSourceMapDecoder, LazySourceMapDecoder
+from ..encoder import SourceMapEncoder, encode_vlq
+
+SOURCE_MAP = json.dumps({
+    'version': 3,
+    'file': 'app.js',
+    'sources': ['app.ts', 'lib/util.ts'],
+    'names': ['main', 'helper'],
+    # an unmapped segment, a line without segments, a negative delta and
+    # values of more than one VLQ digit
+    'mappings': 'AAAAA,SAAS,E;;ACAgBC,kBAAmB;ADA7BA',
+})
+
+DECODERS = (SourceMapDecoder, CompactSourceMapDecoder, LazySourceMapDecoder)
+
+
+def rows(index):
+    return [(t.dst_line, t.dst_col, t.src, t.src_line, t.src_col, t.name) for t in index]
+
+
+class EncoderTestCase(unittest.TestCase):
+    def test_encode_vlq(self):
+        for value, encoded in ((0, 'A'), (1, 'C'), (-1, 'D'), (15, 'e'), (-15, 'f'), (16, 'gB'),
+                               (-16, 'hB'), (123, '2H'), (1 << 20, 'ggggC')):
+            self.assertEqual(encode_vlq(value), encoded)
+
+    def test_round_trip(self):
+        expected = rows(loads(SOURCE_MAP))
+        for cls in DECODERS:
+            smap = json.loads(encode(loads(SOURCE_MAP, cls)))
+            self.assertEqual(smap['mappings'], json.loads(SOURCE_MAP)['mappings'])
+            self.assertEqual(smap['sources'], ['app.ts', 'lib/util.ts'])
+            self.assertEqual(smap['names'], ['main', 'helper'])
+            self.assertEqual(smap['file'], 'app.js')
+            self.assertEqual(rows(loads(json.dumps(smap), cls)), expected)
+
+    def test_file(self):
+        self.assertEqual(SourceMapEncoder().encode_map(loads(SOURCE_MAP), file='out.js')['file'], 'out.js')
+
+    def test_trailing_lines(self):
+        self.assertEqual(SourceMapEncoder().encode_mappings([(0, 0, 0, 0, 0, -1)], 3), 'AAAA;;')
+        self.assertEqual(SourceMapEncoder().encode_mappings([], 2), ';')
@@ -0,0 +1,162 @@
+import json
+import unittest
+from .. import loads, CompactSourceMapDecoder, LazySourceMapDecoder
+
+SOURCE_MAP = json.dumps({
+    'version': 3,
+    'sources': ['src/app.ts', '../lib/util.ts'],
+    'names': ['main', 'helper'],
+    # app.ts 0:4 is generated twice, line 1 starts unmapped, line 3 is empty
+    'mappings': 'AAAAA,IAAI,MCKFC;A,EDJF;AADI,MCKJ,GDHQD;',
+})
+APP = '/home/user/project/src/app.ts'
+UTIL = '/home/user/lib/util.ts'
+
+
+class ReverseIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = loads(SOURCE_MAP)
+
+    def test_getpos(self):
+        getpos = self.index.getpos
+        # the first generated position of a source position
+        self.assertEqual(getpos(0, 4, 'src/app.ts'), (0, 4))
+        # the closest one before it on the line
+        self.assertEqual(getpos(0, 6, APP), (0, 4))
+        self.assertEqual(getpos(1, 5, APP), (1, 2))
+        self.assertEqual(getpos(5, 1, UTIL), (2, 6))
+        # else the next one after it
+        self.assertEqual(getpos(4, 0, UTIL), (2, 6))
+        self.assertEqual(getpos(9, 0, UTIL), None)
+        self.assertEqual(getpos(0, 0, '/home/user/other.ts'), None)
+
+    def test_getpos_any_source(self):
+        # app.ts has 2:8 after 2:0, util.ts 5:0, the earliest generated wins
+        self.assertEqual(self.index.getpos(2, 0), (2, 6))
+        self.assertEqual(self.index.getpos(0, 0), (0, 0))
+
+    def test_getpos_matches_full_scan(self):
+        for source in ('src/app.ts', '../lib/util.ts'):
+            rows = sorted((t.src_line, t.src_col, t.dst_line, t.dst_col) for t in self.index if t.src == source)
+            for line in range(7):
+                for column in range(10):
+                    before = [row for row in rows if row[0] == line and row[1] <= column]
+                    after = [row for row in rows if row[:2] > (line, column)]
+                    if before:
+                        # the first generated position of the closest source position
+                        closest = max(row[:2] for row in before)
+                        expected = min(row[2:] for row in before if row[:2] == closest)
+                    elif after:
+                        expected = min(row[2:] for row in after if row[:2] == after[0][:2])
+                    else:
+                        expected = None
+                    self.assertEqual(self.index.getpos(line, column, source), expected, (source, line, column))
+
+    def test_match_source(self):
+        match_source = self.index.match_source
+        self.assertEqual(match_source('src/app.ts'), 'src/app.ts')
+        self.assertEqual(match_source(APP), 'src/app.ts')
+        self.assertEqual(match_source(UTIL), '../lib/util.ts')
+        self.assertEqual(match_source('C:\\Users\\user\\lib\\util.ts'), '../lib/util.ts')
+        # a suffix has to end at a path separator
+        self.assertEqual(match_source('/home/user/project/mysrc/app.ts'), None)
+        self.assertEqual(match_source('app.ts'), None)
+
+
+class CompactIndexTestCase(unittest.TestCase):
+    cls = CompactSourceMapDecoder
+
+    def test_matches_source_map_index(self):
+        expected = loads(SOURCE_MAP)
+        index = loads(SOURCE_MAP, self.cls)
+        self.assertEqual(len(index), len(expected))
+        self.assertEqual(list(index), list(expected))
+        self.assertEqual([index[i] for i in range(len(index))], list(expected))
+        self.assertEqual(index[-1], expected[-1])
+        self.assertEqual(list(index.sources), list(expected.sources))
+        for line in range(3):
+            for column in range(12):
+                self.assertEqual(index.lookup(line, column), expected.lookup(line, column), (line, column))
+        for source in (None, APP, UTIL):
+            for line in range(7):
+                for column in range(10):
+                    self.assertEqual(index.getpos(line, column, source), expected.getpos(line, column, source),
+                                     (source, line, column))
+
+
+class LazyIndexTestCase(CompactIndexTestCase):
+    cls = LazySourceMapDecoder
+
+    def test_lines_out_of_order(self):
+        # a line decoded before the ones above it still starts from their state
+        expected = loads(SOURCE_MAP)
+        index = loads(SOURCE_MAP, self.cls)
+        for line, column in ((2, 9), (2, 6), (0, 10), (1, 2)):
+            self.assertEqual(index.lookup(line, column), expected.lookup(line, column))
+
+
+SECTIONED_MAP = json.dumps({
+    'version': 3,
+    'file': 'all.js',
+    'sections': [
+        {'offset': {'line': 0, 'column': 0},
+         'map': {'version': 3, 'sources': ['a.ts'], 'names': ['x'], 'mappings': 'AAAAA,IAAI;AACA'}},
+        # starts in the middle of line 2, a.ts shows up again
+        {'offset': {'line': 2, 'column': 5},
+         'map': {'version': 3, 'sources': ['b.ts', 'a.ts'], 'names': ['y', 'x'], 'mappings': 'AAAAA,ICAI;AAAA'}},
+    ],
+})
+
+
+class SectionedIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = loads(SECTIONED_MAP)
+
+    def test_tokens(self):
+        self.assertEqual(len(self.index), 6)
+        self.assertEqual([(t.dst_line, t.dst_col, t.src, t.src_line, t.src_col, t.name) for t in self.index], [
+            (0, 0, 'a.ts', 0, 0, 'x'),
+            (0, 4, 'a.ts', 0, 4, None),
+            (1, 0, 'a.ts', 1, 4, None),
+            # the first line of a section is shifted by its column as well
+            (2, 5, 'b.ts', 0, 0, 'y'),
+            (2, 9, 'a.ts', 0, 4, None),
+            (3, 0, 'a.ts', 0, 4, None),
+        ])
+        self.assertEqual(self.index[3].dst_col, 5)
+        self.assertEqual(list(self.index.sources), ['a.ts', 'b.ts'])
+        self.assertEqual(list(self.index.names), ['x', 'y'])
+
+    def test_lookup(self):
+        for (line, column), expected in (((0, 6), (0, 4, 'a.ts')), ((1, 9), (1, 0, 'a.ts')),
+                                         ((2, 7), (2, 5, 'b.ts')), ((2, 20), (2, 9, 'a.ts')),
+                                         ((3, 3), (3, 0, 'a.ts'))):
+            token = self.index.lookup(line, column)
+            self.assertEqual((token.dst_line, token.dst_col, token.src), expected, (line, column))
+
+    def test_sections_decoded_on_use(self):
+        self.index.lookup(1, 0)
+        self.assertEqual([index is not None for index in self.index.indexes], [True, False])
+        self.index = loads(SECTIONED_MAP)
+        self.index.getpos(0, 0, 'b.ts')
+        self.assertEqual([index is not None for index in self.index.indexes], [False, True])
+
+    def test_getpos(self):
+        getpos = self.index.getpos
+        self.assertEqual(getpos(0, 0, '/project/b.ts'), (2, 5))
+        # a.ts is in both sections, the earliest generated position wins
+        self.assertEqual(getpos(0, 4, 'a.ts'), (0, 4))
+        self.assertEqual(getpos(1, 6, 'a.ts'), (1, 0))
+        self.assertEqual(getpos(0, 0), (0, 0))
+        self.assertEqual(getpos(0, 0, 'c.ts'), None)
+
+    def test_matches_flat_map(self):
+        # the same tokens in one flat map answer the same
+        flat = loads(json.dumps({'version': 3, 'sources': ['a.ts', 'b.ts'], 'names': ['x', 'y'],
+                                 'mappings': 'AAAAA,IAAI;AACA;KCDJC,IDAI;AAAA'}))
+        self.assertEqual(list(flat), list(self.index))
+        for source in (None, 'a.ts', 'b.ts'):
+            for line in range(3):
+                for column in range(6):
+                    self.assertEqual(self.index.getpos(line, column, source), flat.getpos(line, column, source),
+                                     (source, line, column))
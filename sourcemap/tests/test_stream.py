@@ -0,0 +1,70 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from .. import load_file, loads, SourceMapDecodeError
+from ..stream import load_fields
+
+
+class LoadFieldsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, text):
+        path = os.path.join(self.directory, 'test.js.map')
+        with open(path, 'wb') as fp:
+            fp.write(text.encode('utf-8'))
+        return path
+
+    def test_skips_sources_content(self):
+        smap = {'version': 3, 'sources': ['a.ts'], 'names': ['x'], 'mappings': 'AAAAA',
+                'sourcesContent': ['let x = "]}";\n' * 100]}
+        fields = load_fields(self.write(json.dumps(smap)))
+        del smap['sourcesContent']
+        self.assertEqual(fields, smap)
+
+    def test_escaped_strings(self):
+        # quotes after an even number of backslashes end the string
+        text = (r'{"sources": ["a\"b.ts", "c\\", "é\\\"d"], "sourcesContent": ["\\", "\"]}", "\\\\"],'
+                r' "names": [], "mappings": ";AAAA", "x_extra": "\\\\\"{["}')
+        fields = load_fields(self.write(text))
+        self.assertEqual(fields, {'sources': ['a"b.ts', 'c\\', u'é\\"d'], 'names': [], 'mappings': ';AAAA'})
+
+    def test_nested_skipped_values(self):
+        text = ('{"x_extra": {"a": [1, {"b": "]"}, [[]]], "c": null, "d": -1.5e3}, "sourcesContent": [[{}]],'
+                ' "version": 3, "sources": [], "names": [], "mappings": ""}')
+        self.assertEqual(load_fields(self.write(text)),
+                         {'version': 3, 'sources': [], 'names': [], 'mappings': ''})
+
+    def test_sections(self):
+        section = {'version': 3, 'sources': ['b.ts'], 'names': [], 'mappings': 'AAAA',
+                   'sourcesContent': ['b'], 'x_google_ignoreList': [0]}
+        smap = {'version': 3, 'file': 'all.js', 'sections': [
+            {'offset': {'line': 0, 'column': 0}, 'map': dict(section, sources=['a.ts'])},
+            {'offset': {'line': 10, 'column': 4}, 'map': section},
+        ]}
+        fields = load_fields(self.write(json.dumps(smap)))
+        self.assertEqual(fields['file'], 'all.js')
+        self.assertEqual([s['offset'] for s in fields['sections']], [{'line': 0, 'column': 0},
+                                                                     {'line': 10, 'column': 4}])
+        self.assertEqual(fields['sections'][1]['map'], {'version': 3, 'sources': ['b.ts'], 'names': [],
+                                                        'mappings': 'AAAA'})
+
+        index = load_file(self.write(json.dumps(smap)))
+        token = index.lookup(10, 4)
+        self.assertEqual((token.src, token.dst_line, token.dst_col), ('b.ts', 10, 4))
+
+    def test_xssi_prefix(self):
+        text = ')]}\'\n{"version": 3, "sources": ["a.ts"], "names": [], "mappings": "AAAA"}'
+        path = self.write(text)
+        self.assertEqual(load_fields(path)['sources'], ['a.ts'])
+        self.assertEqual(list(load_file(path)), list(loads(text)))
+
+    def test_errors(self):
+        for text in ('', '[]', '{"sources": ["a.ts}', '{"mappings": "AAAA"} x', '{"mappings" "AAAA"}',
+                     '{"names": [1 2]}', '{"x_extra": [1, 2}'):
+            self.assertRaises(SourceMapDecodeError, load_fields, self.write(text))
@@ -0,0 +1,76 @@
+"""
+The plugin's tests, for the parts that do not talk to Sublime Text.
+
+Outside Sublime Text, minimal stand-ins for what the plugin takes from
+the sublime and sublime_plugin modules at import time are put in their
+place. The plugin is loaded as a package of its own so its relative
+imports resolve.
+"""
+import importlib
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Region(object):
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def empty(self):
+        return self.a == self.b
+
+
+class Command(object):
+    pass
+
+
+class TextCommand(Command):
+    def __init__(self, view):
+        self.view = view
+
+
+class WindowCommand(Command):
+    def __init__(self, window):
+        self.window = window
+
+
+def stand_in_modules():
+    try:
+        import sublime  # NOQA
+        import sublime_plugin  # NOQA
+        return
+    except ImportError:
+        pass
+    sublime = types.ModuleType('sublime')
+    sublime.Region = Region
+    sublime.DRAW_NO_FILL = 32
+    sublime.DRAW_NO_OUTLINE = 256
+    sublime.DRAW_SOLID_UNDERLINE = 512
+    sublime.DRAW_SQUIGGLY_UNDERLINE = 2048
+    sublime_plugin = types.ModuleType('sublime_plugin')
+    sublime_plugin.TextCommand = TextCommand
+    sublime_plugin.WindowCommand = WindowCommand
+    sublime_plugin.EventListener = Command
+    sys.modules['sublime'] = sublime
+    sys.modules['sublime_plugin'] = sublime_plugin
+
+
+def load_plugin(name='better_typescript'):
+    stand_in_modules()
+    if name not in sys.modules:
+        package = types.ModuleType(name)
+        package.__path__ = [ROOT]
+        sys.modules[name] = package
+    return importlib.import_module(name + '.TypeScript')
+
+
+TypeScript = load_plugin()
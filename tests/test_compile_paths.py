@@ -0,0 +1,79 @@
+import os
+import unittest
+from collections import OrderedDict
+from . import TypeScript
+
+CompilePathTrie = TypeScript.CompilePathTrie
+split_path = TypeScript.split_path
+
+COMPILE_PATHS = {
+    '/home/user/projects/tsc': '/home/user/projects/first/js',
+    '/home/user/projects/tsc/second/tsc': '../js',
+    '/home/user/projects/other/': 'out',
+}
+
+
+def linear_match(compile_paths, directory):
+    "The deepest root containing directory, found by trying every root"
+    found = None
+    for key_path, target in compile_paths.items():
+        root = split_path(key_path)
+        parts = split_path(directory)
+        if parts[:len(root)] == root and (found is None or len(root) > len(found[0])):
+            found = root, key_path, target, parts[len(root):]
+    if found is None:
+        return None
+    root, key_path, target, rest = found
+    return os.path.normcase(key_path), target, os.path.join(*rest) if rest else '.'
+
+
+@unittest.skipIf(os.sep != '/', 'POSIX paths')
+class CompilePathTrieTestCase(unittest.TestCase):
+    def setUp(self):
+        self.trie = CompilePathTrie(COMPILE_PATHS)
+
+    def test_match(self):
+        self.assertEqual(self.trie.match('/home/user/projects/tsc'),
+                         ('/home/user/projects/tsc', '/home/user/projects/first/js', '.'))
+        self.assertEqual(self.trie.match('/home/user/projects/tsc/models'),
+                         ('/home/user/projects/tsc', '/home/user/projects/first/js', 'models'))
+
+    def test_deepest_root(self):
+        self.assertEqual(self.trie.match('/home/user/projects/tsc/second/tsc/a/b'),
+                         ('/home/user/projects/tsc/second/tsc', '../js', 'a/b'))
+        self.assertEqual(self.trie.match('/home/user/projects/tsc/second'),
+                         ('/home/user/projects/tsc', '/home/user/projects/first/js', 'second'))
+
+    def test_no_match(self):
+        self.assertIsNone(self.trie.match('/home/user/projects'))
+        # a root is matched by whole path components only
+        self.assertIsNone(self.trie.match('/home/user/projects/tsc2'))
+
+    def test_trailing_separator(self):
+        self.assertEqual(self.trie.match('/home/user/projects/other/src'),
+                         ('/home/user/projects/other/', 'out', 'src'))
+        self.assertEqual(self.trie.match('/home/user/projects/tsc/')[2], '.')
+
+    def test_filesystem_root(self):
+        trie = CompilePathTrie({'/': '/out', '/home': 'js'})
+        self.assertEqual(trie.match('/var/lib'), ('/', '/out', 'var/lib'))
+        self.assertEqual(trie.match('/'), ('/', '/out', '.'))
+        self.assertEqual(trie.match('/home/user'), ('/home', 'js', 'user'))
+
+    def test_first_of_equal_roots(self):
+        trie = CompilePathTrie(OrderedDict([('/a', 'first'), ('/a/', 'second')]))
+        self.assertEqual(trie.match('/a/b'), ('/a', 'first', 'b'))
+
+    def test_matches_linear_search(self):
+        directories = ['/', '/home', '/home/user/projects/tsc/second/tsc', '/home/user/projects/tsc/second/x',
+                       '/home/user/projects/other', '/home/user/projects/others/a', '/srv']
+        for directory in directories:
+            self.assertEqual(self.trie.match(directory), linear_match(COMPILE_PATHS, directory), directory)
+
+
+class SplitPathTestCase(unittest.TestCase):
+    @unittest.skipIf(os.sep != '/', 'POSIX paths')
+    def test_split_path(self):
+        self.assertEqual(split_path('/'), [''])
+        self.assertEqual(split_path('/a/b/'), ['', 'a', 'b'])
+        self.assertEqual(split_path('/a//b/../c'), ['', 'a', 'c'])
@@ -0,0 +1,63 @@
+import os
+import unittest
+from . import TypeScript
+
+DIAGNOSTIC_PATTERN = TypeScript.DIAGNOSTIC_PATTERN
+DiagnosticStream = TypeScript.DiagnosticStream
+
+
+class DiagnosticPatternTestCase(unittest.TestCase):
+    def test_match(self):
+        match = DIAGNOSTIC_PATTERN.match("src/app.ts(3,14): error TS2304: Cannot find name 'x'.")
+        self.assertEqual(match.groupdict(), {'file': 'src/app.ts', 'line': '3', 'col': '14', 'category': 'error',
+                                             'code': 'TS2304', 'message': "Cannot find name 'x'."})
+
+    def test_categories(self):
+        for category in ('error', 'warning', 'message', 'suggestion'):
+            match = DIAGNOSTIC_PATTERN.match('a.ts(1,1): %s TS1: text' % category)
+            self.assertEqual(match.group('category'), category)
+
+    def test_paths(self):
+        for path in ('C:\\project\\app.ts', '/home/user/my app (copy).ts', 'app(1).ts'):
+            match = DIAGNOSTIC_PATTERN.match("%s(2,5): error TS1005: ';' expected." % path)
+            self.assertEqual((match.group('file'), match.group('line'), match.group('col')), (path, '2', '5'))
+
+    def test_other_output(self):
+        for line in ("error TS5023: Unknown compiler option 'foo'.", 'Version 1.8.10', '',
+                     'app.ts(1,1): error: no code', 'app.ts: error TS1: no position'):
+            self.assertIsNone(DIAGNOSTIC_PATTERN.match(line), line)
+
+
+class DiagnosticStreamTestCase(unittest.TestCase):
+    def test_parse(self):
+        stream = DiagnosticStream('/project')
+        stream.feed("src/app.ts(3,14): error TS2304: Cannot find name 'x'.\r\n")
+        stream.feed('/lib/util.ts(1,1): warning TS6133: unused\n')
+        stream.feed('Found 2 errors.\n')
+        self.assertEqual(stream.close(), [
+            {'file': os.path.join('/project', 'src/app.ts'), 'line': 2, 'col': 13, 'category': 'error',
+             'code': 'TS2304', 'message': "Cannot find name 'x'."},
+            {'file': '/lib/util.ts', 'line': 0, 'col': 0, 'category': 'warning', 'code': 'TS6133',
+             'message': 'unused'},
+        ])
+
+    def test_batches(self):
+        batches = []
+        stream = DiagnosticStream('/project', batches.append, interval=3600)
+        for i in range(3):
+            stream.feed('a.ts(%d,1): error TS1: e%d' % (i + 1, i))
+        # the first one right away, the rest wait for the interval
+        self.assertEqual([[d['message'] for d in batch] for batch in batches], [['e0']])
+        self.assertEqual(len(stream.close()), 3)
+        self.assertEqual([[d['message'] for d in batch] for batch in batches], [['e0'], ['e1', 'e2']])
+        # nothing left, nothing sent
+        stream.close()
+        self.assertEqual(len(batches), 2)
+
+    def test_no_interval(self):
+        batches = []
+        stream = DiagnosticStream('/project', batches.append, interval=0)
+        for i in range(3):
+            stream.feed('a.ts(%d,1): error TS1: e%d' % (i + 1, i))
+        stream.close()
+        self.assertEqual(len(batches), 3)
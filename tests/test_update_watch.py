@@ -0,0 +1,77 @@
+import random
+import unittest
+from . import TypeScript
+
+
+class View(object):
+    "A buffer that records the edits made to it"
+
+    def __init__(self, text):
+        self.text = text
+        self.edits = []
+
+    def size(self):
+        return len(self.text)
+
+    def substr(self, region):
+        return self.text[region.begin():region.end()]
+
+    def insert(self, edit, pos, text):
+        self.edits.append(('insert', pos, pos, text))
+        self.text = self.text[:pos] + text + self.text[pos:]
+
+    def erase(self, edit, region):
+        self.replace(edit, region, '')
+        self.edits[-1] = ('erase',) + self.edits[-1][1:]
+
+    def replace(self, edit, region, text):
+        self.edits.append(('replace', region.begin(), region.end(), text))
+        self.text = self.text[:region.begin()] + text + self.text[region.end():]
+
+
+def update(old, new, pos=0, diff_limit=None):
+    view = View(old)
+    command = TypeScript.UpdateWatchCommand(view)
+    if diff_limit is not None:
+        command.diff_limit = diff_limit
+    command.run(None, pos, new)
+    return view
+
+
+class UpdateWatchTestCase(unittest.TestCase):
+    def test_unchanged(self):
+        self.assertEqual(update('a\nb\n', 'a\nb\n').edits, [])
+
+    def test_changed_line(self):
+        view = update('var a;\nvar b;\nvar c;\n', 'var a;\nvar B;\nvar c;\n')
+        self.assertEqual(view.text, 'var a;\nvar B;\nvar c;\n')
+        # only the line that changed is touched
+        self.assertEqual(view.edits, [('replace', 7, 14, 'var B;\n')])
+
+    def test_insert_and_delete(self):
+        view = update('a\nb\nc\nd\n', 'a\nx\nb\nd\n')
+        self.assertEqual(view.text, 'a\nx\nb\nd\n')
+        self.assertEqual(view.edits, [('erase', 4, 6, ''), ('insert', 2, 2, 'x\n')])
+
+    def test_last_line_without_newline(self):
+        view = update('a\nb', 'a\nb\nc')
+        self.assertEqual(view.text, 'a\nb\nc')
+
+    def test_empty_view(self):
+        self.assertEqual(update('', 'a\n').text, 'a\n')
+
+    def test_position(self):
+        # text for anywhere but the start of the view replaces it all
+        view = update('a\nb\n', 'a\nb\nc\n', pos=2)
+        self.assertEqual(view.edits, [('erase', 0, 4, ''), ('insert', 2, 2, 'a\nb\nc\n')])
+
+    def test_diff_limit(self):
+        view = update('a\nb\nc\nd\n', 'a\nB\nC\nd\n', diff_limit=1)
+        self.assertEqual(view.edits, [('replace', 2, 6, 'B\nC\n')])
+
+    def test_random_edits(self):
+        rnd = random.Random(18)
+        for _ in range(200):
+            old = ''.join(rnd.choice('abc\n') for _ in range(rnd.randrange(30)))
+            new = ''.join(rnd.choice('abc\n') for _ in range(rnd.randrange(30)))
+            self.assertEqual(update(old, new).text, new, (old, new))